@@ -0,0 +1,157 @@
+## Shared routines for segmenting and measuring cells in the macros in this repository
+## Copy this file to Fiji.app/jars/Lib so it can be imported by the macros
+
+from java.awt import Rectangle
+from java.lang import Math
+from ij.process import ByteProcessor, ImageProcessor
+from ij.measure import Measurements, ResultsTable
+from ij.plugin.filter import EDM, ParticleAnalyzer
+from ij.plugin.frame import RoiManager
+
+
+class CellRegions(object):
+	"""Outlines of the segmented cells kept so every channel is measured by ImageJ without the ROI Manager"""
+	def __init__(self, Roi_List, Width, Height, Background_Distance=None):
+		"""Keeps the bounds and mask of each ROI so they are only worked out once for all channels
+
+		Args:
+			Roi_List ([ij.gui.Roi]): ROIs of the cells
+			Width (int): Width of the image in pixels
+			Height (int): Height of the image in pixels
+			Background_Distance (float, optional): Pixels further than this from every cell are 
+				the background, which is measured with the cells. Defaults to None for no background
+		"""
+		self.Width = Width
+		self.Height = Height
+		self.Rois = list(Roi_List)
+		Image_Bounds = Rectangle(0, 0, Width, Height)
+		# Bounds and mask of each cell, rectangles do not have a mask
+		self.Regions = []
+		for Roi in self.Rois:
+			Bounds = Roi.getBounds()
+			# Cells past the edge of the image are left to ImageJ to clip each time
+			if Image_Bounds.contains(Bounds):
+				self.Regions.append((Bounds, Roi.getMask()))
+			else:
+				self.Regions.append(None)
+		# The background mask is the same for every channel so is only made once
+		self.BackgroundMask = None
+		if Background_Distance is not None:
+			self.BackgroundMask = self._makeBackgroundMask(Background_Distance)
+
+	def _makeBackgroundMask(self, Distance):
+		"""Makes a mask of the pixels further than a distance from every cell
+
+		This is the inverse of the combined cells enlarged by the distance, but comes from one 
+		distance transform so it is only worked out once for all channels
+
+		Args:
+			Distance (float): Distance from the cells in pixels
+
+		Returns:
+			ij.process.ByteProcessor: Mask with the background as 255
+		"""
+		Mask = ByteProcessor(self.Width, self.Height)
+		Mask.setValue(255)
+		Mask.fill()
+		# With no cells the whole image is background
+		if len(self.Rois) == 0:
+			return Mask
+		# Cells are 0 so the distance map has the distance from each pixel to the nearest cell
+		Mask.setValue(0)
+		for Roi in self.Rois:
+			Mask.fill(Roi)
+		Distances = EDM().makeFloatEDM(Mask, 0, False)
+		# Only pixels strictly further than the distance are background
+		Distances.setThreshold(Math.nextUp(float(Distance)), float('Infinity'), ImageProcessor.NO_LUT_UPDATE)
+		return Distances.createMask()
+
+	def measure(self, Processor, Calibration):
+		"""Gets the statistics of every cell and the background mean using ImageJ's statistics
+
+		Each cell is measured with its own mask so overlapping cells are measured in full like separate ROIs
+
+		Args:
+			Processor (ij.process.ImageProcessor): Channel to be measured, the same size as the cells' image
+			Calibration (ij.measure.Calibration): Calibration of the image for the areas
+
+		Returns:
+			([(float, float, float, float, float)], float): Calibrated area, mean, standard deviation, min and max
+				of each cell in ROI order and the mean of the background. The background mean is None if 
+				there is no background and nan if it has no pixels
+		"""
+		PixelArea = Calibration.pixelWidth * Calibration.pixelHeight
+		Output = []
+		for Roi, Region in zip(self.Rois, self.Regions):
+			if Region is None:
+				Processor.setRoi(Roi)
+			else:
+				Processor.setRoi(Region[0])
+				Processor.setMask(Region[1])
+			Stats = Processor.getStats()
+			if Stats.pixelCount == 0:
+				Output.append((0.0, float('nan'), float('nan'), float('nan'), float('nan')))
+			else:
+				Output.append((Stats.pixelCount * PixelArea, Stats.mean, Stats.stdDev, Stats.min, Stats.max))
+		BackgroundMean = None
+		if self.BackgroundMask is not None:
+			# The mask covers the whole image so the roi is set to the whole image before the mask
+			Processor.setRoi(Rectangle(0, 0, self.Width, self.Height))
+			Processor.setMask(self.BackgroundMask)
+			Stats = Processor.getStats()
+			BackgroundMean = Stats.mean if Stats.pixelCount > 0 else float('nan')
+		Processor.resetRoi()
+		return Output, BackgroundMean
+
+
+class ComponentTable(object):
+	"""Particles of a thresholded image with their areas so they can be filtered by size without analysing the image again"""
+	def __init__(self, Imp):
+		"""Finds every particle in the thresholded image, excluding edges and including holes
+
+		Args:
+			Imp (ij.ImagePlus): Thresholded image
+		"""
+		Processor = Imp.getProcessor()
+		# Kept so the table can be made again if the threshold is changed
+		self.Threshold = (Processor.getMinThreshold(), Processor.getMaxThreshold())
+		# Clears the changes flag so later edits to the pixels, such as with the pencil tool, can be spotted
+		Imp.changes = False
+		Results = ResultsTable()
+		# A hidden ROI Manager collects the particles without showing them
+		Manager = RoiManager(True)
+		Analyzer = ParticleAnalyzer(
+			ParticleAnalyzer.ADD_TO_MANAGER | ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES | ParticleAnalyzer.INCLUDE_HOLES,
+			Measurements.AREA, Results, 0, float('Infinity'))
+		Analyzer.setRoiManager(Manager)
+		Analyzer.setHideOutputImage(True)
+		Analyzer.analyze(Imp, Processor)
+		self.Rois = list(Manager.getRoisAsArray())
+		# Areas are kept in pixels to match the size constraints
+		Calibration = Imp.getCalibration()
+		PixelArea = Calibration.pixelWidth * Calibration.pixelHeight
+		self.Areas = [Results.getValueAsDouble(ResultsTable.AREA, Row) / PixelArea for Row in range(Results.size())]
+
+	def matches(self, Imp):
+		"""Checks if the table is still right for the image
+
+		Args:
+			Imp (ij.ImagePlus): Thresholded image the table was made from
+
+		Returns:
+			bool: True if neither the pixels nor the threshold have changed since the table was made
+		"""
+		Processor = Imp.getProcessor()
+		return not Imp.changes and self.Threshold == (Processor.getMinThreshold(), Processor.getMaxThreshold())
+
+	def filter(self, Min_Size, Max_Size):
+		"""Gets the particles within the size constraints
+
+		Args:
+			Min_Size (float): Minimum area in pixels
+			Max_Size (float): Maximum area in pixels
+
+		Returns:
+			[ij.gui.Roi]: ROIs of the particles in the order they were found
+		"""
+		return [Roi for Roi, Area in zip(self.Rois, self.Areas) if Min_Size <= Area <= Max_Size]
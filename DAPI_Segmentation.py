@@ -1,271 +1,496 @@
-import sys, os, re, time
-from ij import IJ, ImagePlus
-from ij.io import DirectoryChooser
-from ij.gui import Overlay, GenericDialog, NonBlockingGenericDialog
+import sys, os, time, csv
+from ij import ImagePlus, ImageStack
+from ij.io import DirectoryChooser, RoiDecoder
+from ij.gui import GenericDialog, NonBlockingGenericDialog
 from ij.measure import Measurements, ResultsTable
-from ij.plugin import Duplicator, RoiRotator, RoiScaler, ImageCalculator
-from ij.plugin.frame import RoiManager
-
-# Gets any open ROI manager, gets the ROI contained and closes it before starting the macro
-OldManager = RoiManager(False).getInstance()
-if OldManager != None:
-	OldRoi = OldManager.getRoisAsArray()
-	OldManager.close()
-
-Settings = Measurements.AREA | Measurements.MEAN
-
-# Dialog where user chooses where their images should be kept
-ImagesChooser = DirectoryChooser('Choose where to find your images')
-ImagesDir = ImagesChooser.getDirectory()
-if ImagesDir == None:
-	sys.exit('No Directory Selected')
-
-# Dialog where user chooses where their ROI are kept
-ImagesChooser = DirectoryChooser('Choose where to find your ROI')
-ROIDir = ImagesChooser.getDirectory()
-if ROIDir == None:
-	sys.exit('No Directory Selected')
-# Dialog where user chooses where to save their data
-SaveGUI = DirectoryChooser('Choose where to save your data')
-SaveDirPath = SaveGUI.getDirectory()
-if SaveDirPath == None:
-	sys.exit('No Directory Selected')
-
-# Gets the data and time 
-LocalTime = time.localtime()
-# Creates a string with the data and time to add to filename
-TimeAddition = time.strftime("%Y-%m-%d_%H-%M-%S_", LocalTime) 
-# Adds the date and time to the filepath for saving the data
-SaveTimePath = os.path.join(SaveDirPath, TimeAddition)
-
-# Defines the pattern for searching for tif/tiff files
-Extension_Pattern = r'\.tif$|\.tiff$'
-
-# Searches through files in the chosen directory for tif files and their paths to a list-v
-
-image_dict = {}
-
-for FileName in os.listdir(ImagesDir):
-	# Uses regular expressions to find tif/tiff extensions
-	if re.search(Extension_Pattern, FileName, flags=re.IGNORECASE):
-		# Splits the filename from extension to label the data
-		Split_Filename = re.split(Extension_Pattern, FileName, flags=re.IGNORECASE)
-		# Gets the wavelength by splitting up the filename at the _
-		get_wavelength = Split_Filename[0].split('_')
-		# Gets the common filename without the wavelength by joining everything bar the wavelength back together
-		common_filename = '_'.join(get_wavelength[0:-1])
-		if common_filename not in image_dict:
-			image_dict[common_filename]={}
-		if re.match('w[1-9]', get_wavelength[-1], flags=re.IGNORECASE): #  Figure out way to put in order using W2, 3, 4 for list.
-			image_dict[common_filename][str(get_wavelength[-1])] = os.path.join(ImagesDir, FileName)
-		else:
-			sys.exit('Unknown File Detected')
-
-Manager = RoiManager()
-
-ApplyAll = False
-
-Failed_List = []
-
-TableDict = {}
-
-
-for Common in image_dict:
-	if ApplyAll != True:
-		Wavelength_list = image_dict[Common].keys()
-		Wavelength_list.sort(key=str.lower)
-		Wavelength_GUI = GenericDialog('Select Phase contrast and DAPI wavelengths')
-		Wavelength_GUI.addRadioButtonGroup('Choose phase contrast wavelength', Wavelength_list, len(Wavelength_list), 1, Wavelength_list[0])
-		Wavelength_GUI.addRadioButtonGroup('Choose DAPI wavelength', Wavelength_list, len(Wavelength_list), 1, Wavelength_list[-1])
-		Wavelength_GUI.addCheckbox('Apply to all?', True)
-		Wavelength_GUI.showDialog()
-		if Wavelength_GUI.wasOKed() != True:
-			sys.exit()
-		Phase_Wave = Wavelength_GUI.getNextRadioButton()
-		DAPI_Wave = Wavelength_GUI.getNextRadioButton()
-		ApplyAll = Wavelength_GUI.getNextBoolean()
-	Plus_Dict = {}
-	for Wavelength in image_dict[Common]:
-		Plus_Dict[Wavelength] = (ImagePlus(image_dict[Common][Wavelength]))
-	# Resets the ROI Manager
-	Manager.reset()
-	Zip_File = os.path.join(ROIDir, Common + '.zip')
-	if os.path.exists(Zip_File) != True:
-		continue
-	Manager.runCommand('Open', Zip_File)
-	ROI_List = Manager.getSelectedRoisAsArray()
-
-	NumRoi = len(ROI_List)
-
-	for ROI_Index in range(0,len(ROI_List)):
-		Cropped_Plus_Dict = {}
-		for Channel in Plus_Dict:
-			imp = Plus_Dict[Channel]
-			# Sets Roi to overlay (Won't transfer to cropped image properly otherwise)
-			PolyOverlay = Overlay(ROI_List[ROI_Index])
-			imp.setOverlay(PolyOverlay) 
-			# Doubles size of area to be cropped (otherwise will have black edges to cropped image)
-			EnlargedROI = RoiScaler().scale(ROI_List[ROI_Index], 2, 2, True)
-			# Sets the enlarged Roi to the image for duplication
-			imp.setRoi(EnlargedROI)
-			# Duplicates cropped section of the image based on 
-			Cropped = Duplicator().run(imp)
-			CroppedOverlay = Cropped.getOverlay()
-			# Gets the ROI from the overlay (Index of 0)
-			InitialROI = CroppedOverlay.get(0)
-			# Gets rid of the overlays
-			PolyOverlay.clear()
-			CroppedOverlay.clear()
-			# Gets bounding rectangle of the drawn ROI
-			InitialBounds = InitialROI.getBounds()
-			# Adds area of bounding rectangle to list, along with the ROI and degrees rotated (0)
-			LowestArea = [(InitialBounds.height * InitialBounds.width), InitialROI, 0]
-			# Defines RoiRotator for later use
-			RR = RoiRotator()
-			# This will loop through 1-360 degrees of rotation
-			for Degree in range(1, 361):
-				# Rotates the Roi by listed No. degrees
-				RotatedROI = RR.rotate(InitialROI, Degree)
-				# Gets the bounding box of the Roi
-				BoundingBox = RotatedROI.getBounds()
-				# Gets area of the bounding box
-				BoundingArea = BoundingBox.height * BoundingBox.width
-				# If the bounding area is lower than the previous lowest bounding area then will replace Lowest area list
-				if BoundingArea < LowestArea[0]:
-					LowestArea = [BoundingArea, RotatedROI, Degree]
-			# Rotates the image by the same number of degrees as the lowest area roi rotation
-			IJ.run(Cropped, "Rotate... ", "angle=" + str(LowestArea[2]) + " grid=1 interpolation=Bilinear stack")
-			# Selects the rotated Roi on the rotated image
-			Cropped.setRoi(LowestArea[1])
-			# Crops the image using the rotated Roi (Will actually use its bounding box)
-			TightCrop = Duplicator().run(Cropped)
-			
-
-			if Channel == Phase_Wave:
-				Phase_Imp = TightCrop
-			elif Channel == DAPI_Wave:
-				DAPI_Imp = TightCrop
-				Cropped_Plus_Dict[Channel] = TightCrop
-			else:
-				Cropped_Plus_Dict[Channel] = TightCrop
-		# Resets the ROI Manager
-		Manager.reset()
-
-		Measure_Rois = []
-		# Duplicates the Phase contrast image for thresholding
-		Phase_Thresh_imp = Phase_Imp.duplicate()
-		# Thresholds the image
-		IJ.setAutoThreshold(Phase_Thresh_imp, "Intermodes light")
-		IJ.run(Phase_Thresh_imp, "Convert to Mask", "method=Intermodes background=Light calculate black")
-		# Runs analyze particles to get cell ROI
-		IJ.run(Phase_Thresh_imp, "Analyze Particles...", "size=200-Infinity exclude clear include add") 
-		# Gets all ROIs in the Roi Manager as a list
-		
-		Phase_ROI_List = Manager.getSelectedRoisAsArray()
-		# Resets the ROI Manager
-		Manager.reset()		
-		# If there is more than one ROI in the ROI manager then will skip this image
-		if len(Phase_ROI_List) > 1:
-			Manager.runCommand(Phase_Thresh_imp, "Combine")
-			# Gets the combined roi
-			Phase_ROI = Phase_Thresh_imp.getRoi()
-		elif len(Phase_ROI_List) == 1:
-			# If it is the only ROI will add it to the List
-			Phase_ROI = Phase_ROI_List[0]
-		else:	
-			ROI_Crop_Name = ROI_List[ROI_Index].getName()
-			Failed_List.append(Common+' | '+ROI_Crop_Name+' | Phase')
-			continue
-		
-		# Adds ROI to List for measurements
-		Measure_Rois.append(Phase_ROI)
-		# Duplicates the DAPI image for thresholding
-		DAPI_Thresh_Imp = DAPI_Imp.duplicate()
-		# Thresholds the image
-		IJ.setAutoThreshold(DAPI_Thresh_Imp, "Intermodes dark")
-		IJ.run(DAPI_Thresh_Imp, "Convert to Mask", "method=Intermodes background=Dark calculate black")
-		# Runs analyze particles to get Nucleoid ROI
-		IJ.run(DAPI_Thresh_Imp, "Analyze Particles...", "size=20-Infinity exclude clear include add")
-		# Gets the ROI's from the Analyze Particles function
-		DAPI_ROI_List = Manager.getSelectedRoisAsArray()
-		# If there are multiple seperate particles they will be combined 
-		if len(DAPI_ROI_List) > 1:
-			Manager.runCommand(DAPI_Thresh_Imp, "Combine")
-			# Gets the combined roi
-			DAPI_ROI = DAPI_Thresh_Imp.getRoi()
-		elif len(DAPI_ROI_List) == 1:
-			DAPI_ROI = DAPI_ROI_List[0]
+from ij.plugin.filter import ParticleAnalyzer
+from ij.process import Blitter, ImageProcessor
+from ij.plugin import RoiRotator, RoiScaler
+
+from java.awt import Rectangle
+from java.io import ByteArrayOutputStream, FileInputStream
+from java.lang import Runtime
+from java.util.concurrent import Callable, Executors
+from java.util.zip import ZipInputStream
+from jarray import zeros
+
+# Shared geometry and image set modules, need to be in Fiji.app/jars/Lib
+from Geometry import minAreaRectangle
+from ImageSets import ImageIndex
+
+def particleMask(Thresh_Imp, Min_Size):
+	"""Gets a mask of the particles in a binary image without using the ROI Manager
+
+	Args:
+		Thresh_Imp (ij.ImagePlus): Binary image with the particles as 255
+		Min_Size (float): Minimum size of the particles in calibrated units
+
+	Returns:
+		(ij.process.ByteProcessor, int): Mask of all of the particles combined, and the number of particles
+	"""
+	Calibration = Thresh_Imp.getCalibration()
+	# The particle analyzer takes the size in pixels
+	Min_Pixels = Min_Size / (Calibration.pixelWidth * Calibration.pixelHeight)
+	# Analyses the 255 pixels whatever the black background setting is
+	Thresh_Imp.getProcessor().setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+	RTable = ResultsTable()
+	# Same as Analyze Particles with exclude and include, showing the masks
+	Analyzer = ParticleAnalyzer(
+		ParticleAnalyzer.SHOW_MASKS | ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES | ParticleAnalyzer.INCLUDE_HOLES, 
+		Measurements.AREA, 
+		RTable, 
+		Min_Pixels, 
+		float('inf')
+	)
+	Analyzer.setHideOutputImage(True)
+	Analyzer.analyze(Thresh_Imp)
+	Mask = Analyzer.getOutputImage().getProcessor()
+	return Mask, RTable.size()
+
+def combineMasks(Mask1, Mask2, Mode):
+	"""Combines two masks of the same size pixel by pixel
+
+	Args:
+		Mask1 (ij.process.ByteProcessor): First mask
+		Mask2 (ij.process.ByteProcessor): Second mask
+		Mode (int): ij.process.Blitter mode, AND for the intersection, OR for the union 
+			or XOR for the pixels in only one of the masks
+
+	Returns:
+		ij.process.ByteProcessor: Combined mask
+	"""
+	Combined = Mask1.duplicate()
+	Combined.copyBits(Mask2, 0, 0, Mode)
+	return Combined
+
+def measureMasks(Processor, Masks, Calibration):
+	"""Gets the mean intensity and area of each mask using ImageJ's statistics
+
+	Args:
+		Processor (ij.process.ImageProcessor): Image to be measured
+		Masks ([ij.process.ByteProcessor]): Masks the same size as the image
+		Calibration (ij.measure.Calibration): Calibration of the image for the areas
+
+	Returns:
+		[(float, float)]: Mean intensity and calibrated area of each mask
+	"""
+	PixelArea = Calibration.pixelWidth * Calibration.pixelHeight
+	Output = []
+	for Mask in Masks:
+		# The mask covers the whole image so the roi is set to the whole image before the mask
+		Processor.setRoi(Rectangle(0, 0, Processor.getWidth(), Processor.getHeight()))
+		Processor.setMask(Mask)
+		Stats = Processor.getStats()
+		Mean = Stats.mean if Stats.pixelCount > 0 else float('nan')
+		Output.append((Mean, Stats.pixelCount * PixelArea))
+	Processor.resetRoi()
+	return Output
+
+class RowBuffer(object):
+	"""Holds rows of results and streams them to a csv file so they are not all kept in memory
+
+	The wavelengths measured are only known once every image set is done, so the rows are streamed to a 
+	part file and the csv file is written with a column for each wavelength that was measured when it is closed
+	"""
+	def __init__(self, Path, Measurements):
+		"""Opens the part file for the rows
+
+		Args:
+			Path (str): Path of the csv file
+			Measurements ([str]): Names of the measurements of each wavelength
+		"""
+		self.Path = Path
+		self.Measurements = Measurements
+		self.Rows = []
+		# Every wavelength that has been measured in at least one cell
+		self.Waves = set()
+		self.File = open(Path + '.part', 'wb')
+		self.Writer = csv.writer(self.File)
+
+	def addRow(self, Common, Cell, Channel_Results):
+		"""Adds a row to the buffer
+
+		Args:
+			Common (str): Name of the image set
+			Cell (int): Number of the cell in the image set
+			Channel_Results ({str: []}): Value of each measurement of each wavelength measured in the cell
+		"""
+		Row = [Common, Cell]
+		for Wavelength in sorted(Channel_Results.keys()):
+			Row.append(Wavelength)
+			Row.extend(Channel_Results[Wavelength])
+		self.Waves.update(Channel_Results.keys())
+		self.Rows.append(Row)
+
+	def flush(self):
+		"""Writes the rows held in the buffer to the part file and clears them"""
+		self.Writer.writerows(self.Rows)
+		self.File.flush()
+		self.Rows = []
+
+	def close(self):
+		"""Writes any remaining rows and the csv file with a column for each measurement of each wavelength measured"""
+		self.flush()
+		self.File.close()
+		Waves = sorted(self.Waves, key=str.lower)
+		Size = len(self.Measurements)
+		PartFile = open(self.Path + '.part', 'rb')
+		OutFile = open(self.Path, 'wb')
+		try:
+			Writer = csv.writer(OutFile)
+			Writer.writerow(['Image', 'Cell'] + [Wavelength + '-' + Measurement for Wavelength in Waves for Measurement in self.Measurements])
+			for Part in csv.reader(PartFile):
+				Channel_Results = {}
+				for Start in range(2, len(Part), Size + 1):
+					Channel_Results[Part[Start]] = Part[Start + 1:Start + 1 + Size]
+				Row = Part[:2]
+				for Wavelength in Waves:
+					# Wavelengths that were not measured in this cell are left blank
+					Row.extend(Channel_Results.get(Wavelength, [''] * Size))
+				Writer.writerow(Row)
+		finally:
+			PartFile.close()
+			OutFile.close()
+		os.remove(self.Path + '.part')
+
+def getImageSets(ImagesDir):
+	"""Groups the tif files in a directory into image sets by the name before the _wN wavelength
+
+	Args:
+		ImagesDir (str): Directory containing the images
+
+	Returns:
+		{str: {str: str}}: Path of each wavelength of each image set
+
+	Raises:
+		ValueError: If a tif file does not end in a wavelength
+	"""
+	# Uses the shared index so unchanged files are not read again on the next run
+	Index = ImageIndex(ImagesDir)
+	if len(Index.Unmatched) > 0:
+		raise ValueError('Unknown File Detected: ' + Index.Unmatched[0])
+	image_dict = {}
+	for common_filename in Index.Sets:
+		image_dict[common_filename] = {}
+		for Wavelength in Index.Sets[common_filename]:
+			image_dict[common_filename][Wavelength] = Index.path(Index.Sets[common_filename][Wavelength])
+	return image_dict
+
+def loadRois(Zip_File):
+	"""Reads the ROI from a RoiSet zip file in order without using the ROI Manager
+
+	Args:
+		Zip_File (str): Path of the zip file
+
+	Returns:
+		[ij.gui.Roi]: ROI in the zip file
+	"""
+	ROI_List = []
+	ZipStream = ZipInputStream(FileInputStream(Zip_File))
+	try:
+		Entry = ZipStream.getNextEntry()
+		while Entry is not None:
+			if Entry.getName().endswith('.roi'):
+				# Reads the entry into memory to decode it
+				Bytes = ByteArrayOutputStream()
+				Buffer = zeros(8192, 'b')
+				Length = ZipStream.read(Buffer)
+				while Length > 0:
+					Bytes.write(Buffer, 0, Length)
+					Length = ZipStream.read(Buffer)
+				ROI = RoiDecoder.openFromByteArray(Bytes.toByteArray())
+				if ROI is not None:
+					ROI_List.append(ROI)
+			Entry = ZipStream.getNextEntry()
+	finally:
+		ZipStream.close()
+	return ROI_List
+
+def stackChannels(Plus_Dict):
+	"""Stacks the wavelengths of an image set so each cell is only cropped and rotated once
+
+	Args:
+		Plus_Dict ({str: ij.ImagePlus}): Image of each wavelength
+
+	Returns:
+		(ij.ImageStack, [str], ij.measure.Calibration, {str: ij.ImageStack}): Stack with a slice for each wavelength, 
+			the wavelength of each slice, the calibration of the images and a single slice stack of the original 
+			image of each wavelength if the stack had to be converted to float, otherwise empty
+	"""
+	Channel_Order = sorted(Plus_Dict.keys(), key=str.lower)
+	Processors = [Plus_Dict[Channel].getProcessor() for Channel in Channel_Order]
+	Width = Processors[0].getWidth()
+	Height = Processors[0].getHeight()
+	Native_Stacks = {}
+	# The channels must be the same type to be stacked
+	if len(set([Processor.getBitDepth() for Processor in Processors])) > 1:
+		# Keeps the original images so thresholds use their own histograms rather than a binned float histogram
+		for Channel, Processor in zip(Channel_Order, Processors):
+			Native_Stacks[Channel] = ImageStack(Width, Height)
+			Native_Stacks[Channel].addSlice(Channel, Processor)
+		Processors = [Processor.convertToFloat() for Processor in Processors]
+	Channel_Stack = ImageStack(Width, Height)
+	for Channel, Processor in zip(Channel_Order, Processors):
+		Channel_Stack.addSlice(Channel, Processor)
+	return Channel_Stack, Channel_Order, Plus_Dict[Channel_Order[0]].getCalibration(), Native_Stacks
+
+def cropCell(Channel_Stack, Cell_Roi):
+	"""Crops and rotates every channel so the cell is lined up with the image in the smallest box
+
+	Only works on copies of the processors so several cells can be cropped at once
+
+	Args:
+		Channel_Stack (ij.ImageStack): Stack with a slice for each wavelength
+		Cell_Roi (ij.gui.Roi): Outline of the cell
+
+	Returns:
+		[ij.process.ImageProcessor]: Tightly cropped processor for each channel
+	"""
+	# Doubles size of area to be cropped (otherwise will have black edges to cropped image)
+	Crop_Bounds = RoiScaler.scale(Cell_Roi, 2, 2, True).getBounds().intersection(
+		Rectangle(0, 0, Channel_Stack.getWidth(), Channel_Stack.getHeight()))
+	# Moves the cell into the coordinates of the crop
+	InitialROI = Cell_Roi.clone()
+	InitialROI.setLocation(Cell_Roi.getXBase() - Crop_Bounds.x, Cell_Roi.getYBase() - Crop_Bounds.y)
+	# Finds the angle of the smallest rectangle around the outline of the ROI
+	Polygon = InitialROI.getFloatPolygon()
+	RectangleAngle, RectangleArea = minAreaRectangle(zip(Polygon.xpoints, Polygon.ypoints))
+	# Rotating by minus the angle of the rectangle lines it up with the image
+	Degree = (-RectangleAngle) % 90
+	# Rotates the Roi once by the exact angle
+	Tight_Bounds = RoiRotator.rotate(InitialROI, Degree).getBounds()
+	Cropped_List = []
+	for Slice in range(1, Channel_Stack.getSize() + 1):
+		# The stack makes a new processor each time so its roi is not shared
+		Processor = Channel_Stack.getProcessor(Slice)
+		Processor.setRoi(Crop_Bounds)
+		Cropped = Processor.crop()
+		# Rotates the same as Rotate with bilinear interpolation
+		Cropped.setInterpolationMethod(ImageProcessor.BILINEAR)
+		Cropped.setBackgroundValue(0)
+		Cropped.rotate(Degree)
+		# Crops the image to the bounding box of the rotated Roi
+		Cropped.setRoi(Tight_Bounds)
+		Cropped_List.append(Cropped.crop())
+	return Cropped_List
+
+def thresholdMask(Processor, Method, Calibration, Min_Size):
+	"""Thresholds an image and gets a mask of the particles in it
+
+	Args:
+		Processor (ij.process.ImageProcessor): Image to threshold
+		Method (str): Auto threshold method and background
+		Calibration (ij.measure.Calibration): Calibration of the image for the particle size
+		Min_Size (float): Minimum size of the particles in calibrated units
+
+	Returns:
+		(ij.process.ByteProcessor, int): Mask of all of the particles combined, and the number of particles
+	"""
+	Thresh_Processor = Processor.duplicate()
+	Thresh_Processor.setAutoThreshold(Method)
+	# Same as Convert to Mask with a black background
+	Thresh_Imp = ImagePlus('Mask', Thresh_Processor.createMask())
+	Thresh_Imp.setCalibration(Calibration)
+	return particleMask(Thresh_Imp, Min_Size)
+
+def analyzeCell(Common, ROI_Index, Cell_Roi, Channel_Stack, Channel_Order, Calibration, Native_Stacks, Phase_Wave, DAPI_Wave):
+	"""Crops, thresholds and measures a single cell
+
+	Args:
+		Common (str): Name of the image set
+		ROI_Index (int): Index of the cell in the image set
+		Cell_Roi (ij.gui.Roi): Outline of the cell
+		Channel_Stack (ij.ImageStack): Stack with a slice for each wavelength
+		Channel_Order ([str]): Wavelength of each slice
+		Calibration (ij.measure.Calibration): Calibration of the images
+		Native_Stacks ({str: ij.ImageStack}): Original image of each wavelength if the stack was converted to float
+		Phase_Wave (str): Phase contrast wavelength
+		DAPI_Wave (str): DAPI wavelength
+
+	Returns:
+		({str: [float]}, str): Measurements of each measured channel and a description of the failure, 
+			the failure is None if the cell was measured
+	"""
+	Cropped_Dict = dict(zip(Channel_Order, cropCell(Channel_Stack, Cell_Roi)))
+	ROI_Crop_Name = Cell_Roi.getName()
+	# Thresholds the original images if the stack was converted so the thresholds are the same as before stacking
+	Threshold_Dict = {}
+	for Wave in (Phase_Wave, DAPI_Wave):
+		if Wave in Native_Stacks:
+			Threshold_Dict[Wave] = cropCell(Native_Stacks[Wave], Cell_Roi)[0]
 		else:
-			ROI_Crop_Name = ROI_List[ROI_Index].getName()
-			Failed_List.append(Common+' | '+ROI_Crop_Name+' | DAPI')
+			Threshold_Dict[Wave] = Cropped_Dict[Wave]
+	# Gets a mask of the cell, multiple particles are combined into one mask
+	Phase_Mask, Phase_Count = thresholdMask(Threshold_Dict[Phase_Wave], "Intermodes light", Calibration, 200)
+	if Phase_Count == 0:
+		return [], Common+' | '+str(ROI_Crop_Name)+' | Phase'
+	# Gets a mask of the nucleoid, multiple particles are combined into one mask
+	DAPI_Mask, DAPI_Count = thresholdMask(Threshold_Dict[DAPI_Wave], "Intermodes dark", Calibration, 20)
+	if DAPI_Count == 0:
+		return [], Common+' | '+str(ROI_Crop_Name)+' | DAPI'
+	# The excluded region is the pixels in only one of the cell and nucleoid
+	Excluded_Mask = combineMasks(Phase_Mask, DAPI_Mask, Blitter.XOR)
+	# Cell, nucleoid and excluded regions in the order they are measured
+	Measure_Masks = [Phase_Mask, DAPI_Mask, Excluded_Mask]
+
+	Channel_Results = {}
+	for Data_Channel in Channel_Order:
+		# The phase contrast channel is only used to find the cell
+		if Data_Channel == Phase_Wave:
 			continue
-		# Adds ROI to List for measurements
-		Measure_Rois.append(DAPI_ROI)
-		# Resets the ROI Manager
-		Manager.reset()
-		Manager.addRoi(Phase_ROI)
-		Manager.addRoi(DAPI_ROI)
-		Manager.runCommand(DAPI_Thresh_Imp, "XOR")
-		Subtracted_ROI = DAPI_Thresh_Imp.getRoi()
-		Measure_Rois.append(Subtracted_ROI)
-		Manager.reset()
-
-		for Data_Channel in Cropped_Plus_Dict:
-			Stats_List = []
-			if Data_Channel not in TableDict:
-				TableDict[Data_Channel] = []
-				for NumTables in range(0, 11):
-					TableDict[Data_Channel].append(ResultsTable())
-
-			while NumRoi > TableDict[Data_Channel][9].size():
-				for Table in TableDict[Data_Channel]:
-					Table.incrementCounter()
-			
-			Cropped_Imp = Cropped_Plus_Dict[Data_Channel]
-			for MRoi in Measure_Rois:
-				Cropped_Imp.setRoi(MRoi)
-				Stats = Cropped_Imp.getStatistics()
-				Stats_List.append(Stats)
-
-			Cell_Mean = Stats_List[0].mean
-			Cell_Area = Stats_List[0].area
-			Nucleoid_Mean = Stats_List[1].mean
-			Nucleoid_Area = Stats_List[1].area
-			Excluded_Mean = Stats_List[2].mean
-			Excluded_Area = Stats_List[2].area
-			Nucleoid_Fraction = Nucleoid_Area/Cell_Area
-			Nucleoid_Excluded_Fraction = Nucleoid_Area/Excluded_Area
-			Nucleoid_Excluded_Diff = Excluded_Mean-Nucleoid_Mean
-			Normalised_Nucleoid_Excluded_Diff = Nucleoid_Excluded_Diff/Cell_Mean
-			Nucleoid_Compaction = Cell_Area/Nucleoid_Area			
-
-			Output_List = [Cell_Mean, Cell_Area, Nucleoid_Mean, Nucleoid_Area, Excluded_Mean, Excluded_Area, Nucleoid_Fraction, 
-						   Nucleoid_Excluded_Fraction, Nucleoid_Excluded_Diff, Normalised_Nucleoid_Excluded_Diff, Nucleoid_Compaction]
-
-			for List_Index in range(0, 11):
-				TableDict[Data_Channel][List_Index].setValue('Cell', ROI_Index, ROI_Index + 1)
-				TableDict[Data_Channel][List_Index].setValue(Common, ROI_Index, Output_List[List_Index])
-			Cropped_Imp.close()
+		# Measures all three regions of the channel
+		Stats_List = measureMasks(Cropped_Dict[Data_Channel], Measure_Masks, Calibration)
+
+		Cell_Mean, Cell_Area = Stats_List[0]
+		Nucleoid_Mean, Nucleoid_Area = Stats_List[1]
+		Excluded_Mean, Excluded_Area = Stats_List[2]
+		Nucleoid_Fraction = Nucleoid_Area/Cell_Area
+		Nucleoid_Excluded_Fraction = Nucleoid_Area/Excluded_Area
+		Nucleoid_Excluded_Diff = Excluded_Mean-Nucleoid_Mean
+		Normalised_Nucleoid_Excluded_Diff = Nucleoid_Excluded_Diff/Cell_Mean
+		Nucleoid_Compaction = Cell_Area/Nucleoid_Area			
 
+		Output_List = [Cell_Mean, Cell_Area, Nucleoid_Mean, Nucleoid_Area, Excluded_Mean, Excluded_Area, Nucleoid_Fraction, 
+					   Nucleoid_Excluded_Fraction, Nucleoid_Excluded_Diff, Normalised_Nucleoid_Excluded_Diff, Nucleoid_Compaction]
+		Channel_Results[Data_Channel] = Output_List
+	return Channel_Results, None
 
+class CellTask(Callable):
+	"""Callable that analyses a single cell so it can be run in a worker pool"""
+	def __init__(self, *Args):
+		"""Initializes the task with the arguments for analyzeCell"""
+		self.Args = Args
+
+	def call(self):
+		"""Method that is called by the worker pool"""
+		return analyzeCell(*self.Args)
+
+# Names of the measurements for each cell, in the order they are calculated
 SaveList = ['Cell-Mean', 'Cell-Area', 'Nucleoid-Mean', 'Nucleoid-Area', 'Excluded-Mean', 'Excluded-Area', 'Nucleoid-Fraction', 
 			'Nucleoid-Excluded-Fraction', 'Nucleoid-Excluded-Difference', 'Nucleoid-Excluded-Difference-Normalised', "Nucleoid-Compaction"]
-for Key in TableDict:
-	for Index in range(0, 11):
-		TableDict[Key][Index].save(SaveTimePath + Key + '_' + SaveList[Index] + '.csv')
-
-Manager.show()
-if len(Failed_List) > 0:
-	ErrorFile = open(SaveTimePath+'_Errors.txt', 'w')
-	GUI_of_Failure = NonBlockingGenericDialog('Failed Files')
-	GUI_of_Failure.hideCancelButton()
-	for Failure in Failed_List:
-		GUI_of_Failure.addMessage(Failure)
-		ErrorFile.write(Failure+'\n')
-	ErrorFile.close()
-	GUI_of_Failure.showDialog()
-
-# If there was an open ROI Manager when the macro was run, this section will Re-open it
-if OldManager != None:
-	for R in OldRoi:
-		Manager.addRoi(R)
+
+def run(ImagesDir, ROIDir, SaveDirPath, Phase_Wave, DAPI_Wave, Workers=1, Wavelength_Chooser=None):
+	"""Segments and measures every cell of every image set, can be run headless
+
+	Args:
+		ImagesDir (str): Directory containing the _wN tif images
+		ROIDir (str): Directory containing a RoiSet zip of the cells for each image set
+		SaveDirPath (str): Directory to save the results to
+		Phase_Wave (str): Phase contrast wavelength, e.g. w1
+		DAPI_Wave (str): DAPI wavelength, e.g. w2
+		Workers (int, optional): Number of cells to analyse at once. Defaults to 1.
+		Wavelength_Chooser (function, optional): Called with the image set name and its wavelengths 
+			to get the phase contrast and DAPI wavelengths for each image set instead. Defaults to None.
+
+	Returns:
+		[str]: Description of each cell that failed
+	"""
+	# Gets the data and time 
+	LocalTime = time.localtime()
+	# Creates a string with the data and time to add to filename
+	TimeAddition = time.strftime("%Y-%m-%d_%H-%M-%S_", LocalTime) 
+	# Adds the date and time to the filepath for saving the data
+	SaveTimePath = os.path.join(SaveDirPath, TimeAddition)
+
+	image_dict = getImageSets(ImagesDir)
+	Failed_List = []
+	# One row per cell, written after each image so the results are not all kept until the end
+	# Only the wavelengths that were measured get a column for each measurement
+	Results = RowBuffer(SaveTimePath + 'Results.csv', SaveList)
+	Pool = Executors.newFixedThreadPool(max(1, Workers))
+	try:
+		for Common in sorted(image_dict.keys()):
+			Zip_File = os.path.join(ROIDir, Common + '.zip')
+			if os.path.exists(Zip_File) != True:
+				continue
+			if Wavelength_Chooser is not None:
+				Wavelength_list = sorted(image_dict[Common].keys(), key=str.lower)
+				Phase_Wave, DAPI_Wave = Wavelength_Chooser(Common, Wavelength_list)
+			# Image sets without the phase contrast or DAPI image cannot be segmented
+			Missing_Waves = [Wave for Wave in (Phase_Wave, DAPI_Wave) if Wave not in image_dict[Common]]
+			if len(Missing_Waves) > 0:
+				for Wave in Missing_Waves:
+					Failed_List.append(Common + ' | ' + str(Wave) + ' missing')
+				continue
+			Plus_Dict = {}
+			for Wavelength in image_dict[Common]:
+				Plus_Dict[Wavelength] = (ImagePlus(image_dict[Common][Wavelength]))
+			Channel_Stack, Channel_Order, Calibration, Native_Stacks = stackChannels(Plus_Dict)
+			ROI_List = loadRois(Zip_File)
+			Futures = [Pool.submit(CellTask(Common, ROI_Index, ROI_List[ROI_Index], Channel_Stack, Channel_Order, 
+										   Calibration, Native_Stacks, Phase_Wave, DAPI_Wave)) 
+					   for ROI_Index in range(0,len(ROI_List))]
+			# Collects the cells in order so the output is the same however many workers are used
+			for ROI_Index, Future in enumerate(Futures):
+				Channel_Results, Failure = Future.get()
+				if Failure is not None:
+					Failed_List.append(Failure)
+					continue
+				Results.addRow(Common, ROI_Index + 1, Channel_Results)
+			# Writes the cells of this image to the results file
+			Results.flush()
+			for Channel_Imp in Plus_Dict.values():
+				Channel_Imp.close()
+	finally:
+		Pool.shutdown()
+		Results.close()
+
+	if len(Failed_List) > 0:
+		ErrorFile = open(SaveTimePath+'_Errors.txt', 'w')
+		for Failure in Failed_List:
+			ErrorFile.write(Failure+'\n')
+		ErrorFile.close()
+	return Failed_List
+
+def chooseWavelengths():
+	"""Makes a function that asks the user for the wavelengths of each image set until they apply it to all
+
+	Returns:
+		function: Takes the image set name and its wavelengths and returns the phase contrast and DAPI wavelengths
+	"""
+	Chosen = {}
+	def chooser(Common, Wavelength_list):
+		if Chosen.get('ApplyAll') != True:
+			Wavelength_GUI = GenericDialog('Select Phase contrast and DAPI wavelengths')
+			Wavelength_GUI.addRadioButtonGroup('Choose phase contrast wavelength', Wavelength_list, len(Wavelength_list), 1, Wavelength_list[0])
+			Wavelength_GUI.addRadioButtonGroup('Choose DAPI wavelength', Wavelength_list, len(Wavelength_list), 1, Wavelength_list[-1])
+			Wavelength_GUI.addCheckbox('Apply to all?', True)
+			Wavelength_GUI.showDialog()
+			if Wavelength_GUI.wasOKed() != True:
+				sys.exit()
+			Chosen['Waves'] = (Wavelength_GUI.getNextRadioButton(), Wavelength_GUI.getNextRadioButton())
+			Chosen['ApplyAll'] = Wavelength_GUI.getNextBoolean()
+		return Chosen['Waves']
+	return chooser
+
+if __name__ == "__main__":
+	# Dialog where user chooses where their images should be kept
+	ImagesChooser = DirectoryChooser('Choose where to find your images')
+	ImagesDir = ImagesChooser.getDirectory()
+	if ImagesDir == None:
+		sys.exit('No Directory Selected')
+
+	# Dialog where user chooses where their ROI are kept
+	ImagesChooser = DirectoryChooser('Choose where to find your ROI')
+	ROIDir = ImagesChooser.getDirectory()
+	if ROIDir == None:
+		sys.exit('No Directory Selected')
+	# Dialog where user chooses where to save their data
+	SaveGUI = DirectoryChooser('Choose where to save your data')
+	SaveDirPath = SaveGUI.getDirectory()
+	if SaveDirPath == None:
+		sys.exit('No Directory Selected')
+
+	try:
+		Failed_List = run(ImagesDir, ROIDir, SaveDirPath, None, None, 
+						  Workers=Runtime.getRuntime().availableProcessors(), 
+						  Wavelength_Chooser=chooseWavelengths())
+	except ValueError as Error:
+		sys.exit(str(Error))
+
+	if len(Failed_List) > 0:
+		GUI_of_Failure = NonBlockingGenericDialog('Failed Files')
+		GUI_of_Failure.hideCancelButton()
+		for Failure in Failed_List:
+			GUI_of_Failure.addMessage(Failure)
+		GUI_of_Failure.showDialog()
@@ -4,22 +4,20 @@
 ## The user can input size filters for the analyse particles function as well as seperate out cells on the binary image using the pencil tool 
 
 from ij import IJ, ImagePlus, WindowManager
-from ij.plugin import RoiEnlarger
 from ij.plugin.frame import RoiManager
-from ij.plugin.filter import Analyzer
-from ij.measure import ResultsTable, Measurements
-from ij.gui import GenericDialog,NonBlockingGenericDialog
+from ij.measure import ResultsTable
+from ij.gui import GenericDialog,NonBlockingGenericDialog,Overlay
 from ij.io import DirectoryChooser,FileSaver,SaveDialog
 from fiji.util.gui import GenericDialogPlus
-import sys,os,re
+from CellMeasurements import CellRegions, ComponentTable
+from ImageSets import ImageIndex
+import sys
 
 ##Gets original standard output to can restore to normal
 NormOut = sys.stdout
 
-##Gets the original settings for measurements
-original_setting = Analyzer().getMeasurements()
-
-MeasurementSetting = Measurements.MEAN + Measurements.STD_DEV + Measurements.MIN_MAX + Measurements.AREA
+##Distance in pixels around the cells that is left out of the background
+BackgroundDistance = 25
 
 ##Opens a dialog that lets user choose the folder containing images they want to analyse-v
 image_dir = DirectoryChooser("Choose Folder Containing Images").getDirectory()
@@ -70,18 +68,11 @@ VarFile = open(stdDevsavepath,'a+')
 AreaFile = open(areaSavePath,'a+')
 
 
-file_list = os.listdir(image_dir)
+##Groups the images into sets by their name without the wavelength
+image_index = ImageIndex(image_dir)
 image_dict = {}
 
-WaveList = []
-for CheckFilename in file_list:
-	WaveObj = re.search('_w[1-9]', CheckFilename, flags=re.IGNORECASE)
-	if WaveObj:
-		WavelengthStr = WaveObj.group(0)[1:]
-		if WavelengthStr not in WaveList:
-			WaveList.append(WavelengthStr)
-
-WaveList.sort()
+WaveList = image_index.wavelengths()
 
 ##Allows user to input size restrictions for Particle analysis
 settings_dialog = GenericDialog("Input Size Restrictions")
@@ -103,38 +94,15 @@ if settings_dialog.wasCanceled():
 	sys.exit('Cancelled')
 
 
-##This loop pulls out all the TIF files and uses re to determine if its wavelength 1 (phase contrast) or any other (fluorescence) and adds it to a dictionary-----------v
-for image_filename in file_list:
-	## This checks that the file is a tif/tiff file		
-	if re.search('\.tif{1,2}$', image_filename, flags=re.IGNORECASE):
-		WavelengthIndex = None
-		## Splits by underscore to find the wavelength
-		get_wavelength = image_filename.split('_')
-		## Iterates through split filename to get wavelength list item
-		for w in range(0, len(get_wavelength)):
-			if re.match('w[1-9]', get_wavelength[w], flags=re.IGNORECASE):
-				WavelengthIndex = w
-				break
-		## Checks that it has actually found a wavelength for this file
-		if WavelengthIndex:
-			## Gets the list item for determining wavelength
-			Wavelength = get_wavelength[WavelengthIndex]
-			## Deletes the item with the wavelength info so can generate common filename
-			get_wavelength.pop(WavelengthIndex)
-			## Common filename will act as the dictionary key in image_dict
-			common_filename = '_'.join(get_wavelength)
-			## Adds the dictionary item if it does not exist
-			if common_filename not in image_dict:
-				## Each dictionary item consists of a string containing the filename of the brightfield image and then a list containing filenames for fluorescent images
-				image_dict[common_filename] = ['',[]]
-			## Assigns the brightfield wavelength
-			if re.match(BrightWave, Wavelength, flags=re.IGNORECASE):
-				image_dict[common_filename][0] = image_filename
-				image_dict[common_filename][1].append(image_filename)
-			## Assigns the fluorescence wavelength
-			elif re.match('w[1-9]',Wavelength, flags=re.IGNORECASE):
-				image_dict[common_filename][1].append(image_filename)
-##This loop pulls out all the TIF files and uses re to determine if its wavelength 1 (phase contrast) or any other (fluorescence) and adds it to a dictionary-----------^
+##This loop goes through the image sets and splits them into the segmentation wavelength and the fluorescence wavelengths-----------v
+for common_filename in image_index.Sets:
+	Channels = image_index.Sets[common_filename]
+	## Each dictionary item consists of a string containing the filename of the brightfield image and then a list containing filenames for fluorescent images
+	image_dict[common_filename] = [Channels.get(BrightWave, ''), []]
+	for Wavelength in sorted(Channels.keys()):
+		## The segmentation wavelength is measured as well as the fluorescence wavelengths
+		image_dict[common_filename][1].append(Channels[Wavelength])
+##This loop goes through the image sets and splits them into the segmentation wavelength and the fluorescence wavelengths-----------^
 
 ConfirmAll = False
 
@@ -153,22 +121,23 @@ for image_set in DictKeys:
 		##Runs the Threshold command setting it to having a dark background
 		IJ.run(phase_img, "Threshold...","BlackBackground=True")
 	IJ.setAutoThreshold(phase_img, "Default")
+	##Gets the image size for measuring the cells
+	ImageWidth = phase_img.getWidth()
+	ImageHeight = phase_img.getHeight()
 	Analysis_done = False
 	skipcheck = False
+	Components = None
 	while Analysis_done == False:
-		##Creates options for Analyze particles function using user input for min and max size.
-		options = "size=" + str(minsize) + "-" + str(maxsize) + " exclude clear include add pixel"
-		IJ.run(phase_img, "Remove Overlay", "")
-		##Runs the Analyze particles function
-		IJ().run(phase_img,"Analyze Particles...", options)
-		##Gets access to the ROI manager
-		RM = RoiManager.getInstance()
-		try:
-			##Gets indexes of ROIs in the ROI manager
-			Ind2 = RM.getIndexes()
-			RM.select(Ind2[0])
-		except:
-			pass
+		##Finds the particles again only if the image has been edited or the threshold changed, otherwise reuses them
+		if Components == None or not Components.matches(phase_img):
+			Components = ComponentTable(phase_img)
+		##Filters the particles using user input for min and max size
+		Particles = Components.filter(float(minsize), float(maxsize))
+		##Draws the particles over the image
+		ParticleOverlay = Overlay()
+		for Particle in Particles:
+			ParticleOverlay.add(Particle)
+		phase_img.setOverlay(ParticleOverlay)
 		##Creates dialog that allows users to confirm ROI generated, or repeat the analysis
 		gd = NonBlockingGenericDialog('Confirm?')
 		gd.enableYesNoCancel("Confirm","Repeat Analyze Particles")
@@ -185,8 +154,8 @@ for image_set in DictKeys:
 				imagewindow = WindowManager.getCurrentWindow()
 				WindowManager.setCurrentWindow(imagewindow)
 				IJ.run("Close")
-				IJ.selectWindow("ROI Manager")
-				IJ.run("Close")
+				if RoiManager.getInstance() != None:
+					RoiManager.getInstance().close()
 				IJ.selectWindow("Threshold")
 				IJ.run("Close")
 				sys.exit('Cancelled')
@@ -198,8 +167,6 @@ for image_set in DictKeys:
 					ConfirmAll = True
 				Analysis_done = True
 			else:
-				RM.reset()
-				IJ.run("Select None")
 				minsize = gd.getNextString()
 				maxsize = gd.getNextString()
 				Analysis_done = False
@@ -214,6 +181,16 @@ for image_set in DictKeys:
 	if skipcheck == True:
 		continue
 		
+	if len(Particles) == 0:
+		IJ.error("No ROIs found for "+image_set)
+		continue
+	##Adds the confirmed particles to the ROI Manager so they can be saved
+	RM = RoiManager.getInstance()
+	if RM == None:
+		RM = RoiManager()
+	RM.reset()
+	for Particle in Particles:
+		RM.addRoi(Particle)
 	##This saves the ROIs to the directory chosen
 	ROI_path = roi_dir+image_set+".zip"	
 	rm = RoiManager.getInstance()
@@ -222,6 +199,13 @@ for image_set in DictKeys:
 	except:
 		IJ.error("No ROIs found for "+image_set)
 		continue
+
+	##Gets the bounds and mask of each cell once so every channel is measured from the same regions
+	##The background is everything further than BackgroundDistance from the cells, this is the same for every channel
+	if SubBackground:
+		Cells = CellRegions(rm.getRoisAsArray(), ImageWidth, ImageHeight, BackgroundDistance)
+	else:
+		Cells = CellRegions(rm.getRoisAsArray(), ImageWidth, ImageHeight)
 		
 	##This loop goes through all the fluorescence images and gets the mean values-------------------v
 	for fluor_image_filename in image_dict[image_set][1]:
@@ -231,49 +215,15 @@ for image_set in DictKeys:
 		if fluor_image_filename == image_dict[image_set][0]:
 			IJ.run(fluor_img, "8-bit","")
 			IJ.run(fluor_img, "Invert", "")
-		##Gets indexes of ROI and selects all of them
-		RM.deselect()
-		Ind = RM.getIndexes()
-		RM.setSelectedIndexes(Ind)
-		##Instance of Analyzer which will be used
-		An = Analyzer(fluor_img)
-		##Sets measurements taken to mean and stdDev
-		An.setMeasurements(MeasurementSetting)
-		##Measures mean for all ROIs
-		measurement = RM.multiMeasure(fluor_img)
-		##Gets mean out of results table and adds it to a list-v
-		x = 0
-		mean_list = []
-		stdDev_list=[]
-		max_list = []
-		area_list = []
-		Headings = measurement.getHeadings()
-		for Column in Headings:
-			Index = measurement.getColumnIndex(Column)
-			Val = measurement.getColumn(Index)
-			if re.search("Mean",Column):
-				mean_list.append(Val[0])
-			elif re.search("StdDev",Column):
-				stdDev_list.append(Val[0])
-			elif re.search("Max",Column):
-				max_list.append(Val[0])
-			elif re.search("Area",Column):
-				area_list.append(Val[0])
-		##Gets mean out of results table and adds it to a list-^
+		##Measures the area, mean, standard deviation, min and max of all cells and the background mean with the cached regions
+		CellStats, bgmean = Cells.measure(fluor_img.getProcessor(), fluor_img.getCalibration())
+		##Splits the measurements into a list for each-v
+		area_list = [Stats[0] for Stats in CellStats]
+		mean_list = [Stats[1] for Stats in CellStats]
+		stdDev_list = [Stats[2] for Stats in CellStats]
+		max_list = [Stats[4] for Stats in CellStats]
+		##Splits the measurements into a list for each-^
 		if SubBackground:
-			##Combines ROI
-			RM.runCommand(fluor_img,"Combine")
-			##enlarges combined ROI to avoid fluorescence around cell
-			cur_roi = fluor_img.getRoi()
-			enlarged_roi = RoiEnlarger().enlarge(cur_roi,25)
-			##Inverts the ROI so selecting Background not the cells
-			fluor_img.setRoi(enlarged_roi)
-			IJ().run(fluor_img,"Make Inverse","")
-			##Measures the mean of background
-			measured = Analyzer(fluor_img).measure()
-			##Pulls mean value out
-			bgresults = Analyzer.getResultsTable()
-			bgmean = bgresults.getValue(1,0)
 			##Goes through the list of cells and prints the mean fluorescence minus the background-v
 			sys.stdout=MeanFile
 			print fluor_image_filename,",","Subtracted Background:"+str(bgmean),",",
@@ -312,10 +262,9 @@ for image_set in DictKeys:
 
 ## Closes the fluorescence image to release memory
 fluor_img.close()
-##Restores original settings for measurements
-Analyzer().setMeasurements(original_setting)
 ##Closes the ROI Manager
-RM.close()
+if RoiManager.getInstance() != None:
+	RoiManager.getInstance().close()
 ##Restores standard output to normal
 sys.stdout = NormOut
 ##Closes the results files
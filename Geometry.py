@@ -0,0 +1,154 @@
+## Shared geometry routines for the macros in this repository
+## Copy this file to Fiji.app/jars/Lib so it can be imported by the macros
+
+import math
+
+
+def cross(Origin, Point1, Point2):
+	"""Gets the z component of the cross product of two vectors from a shared origin
+
+	Args:
+		Origin (tuple): X and Y coordinates of the shared origin
+		Point1 (tuple): X and Y coordinates of the end of the first vector
+		Point2 (tuple): X and Y coordinates of the end of the second vector
+
+	Returns:
+		float: Positive if the turn from Point1 to Point2 is anticlockwise, negative if clockwise and 0 if collinear
+	"""
+	return ((Point1[0] - Origin[0]) * (Point2[1] - Origin[1])
+			- (Point1[1] - Origin[1]) * (Point2[0] - Origin[0]))
+
+
+def distanceBetweenPoints(Point1, Point2):
+	"""Calculates the distance between two points
+
+	Args:
+		Point1 (tuple): X and Y coordinates of the first point
+		Point2 (tuple): X and Y coordinates of the second point
+
+	Returns:
+		float: Distance between the two points
+	"""
+	return math.hypot(Point1[0] - Point2[0], Point1[1] - Point2[1])
+
+
+def convexHull(Point_List):
+	"""Gets the convex hull of a list of points using the monotone chain algorithm
+
+	Args:
+		Point_List ([tuple]): X and Y coordinates of each point
+
+	Returns:
+		[tuple]: Points on the hull in anticlockwise order without collinear points
+	"""
+	Points = sorted(set([(Point[0], Point[1]) for Point in Point_List]))
+	if len(Points) <= 2:
+		return Points
+	# Builds the lower and upper halves of the hull from the sorted points
+	Lower = []
+	for Point in Points:
+		while len(Lower) >= 2 and cross(Lower[-2], Lower[-1], Point) <= 0:
+			Lower.pop()
+		Lower.append(Point)
+	Upper = []
+	for Point in reversed(Points):
+		while len(Upper) >= 2 and cross(Upper[-2], Upper[-1], Point) <= 0:
+			Upper.pop()
+		Upper.append(Point)
+	# The last point of each half is the first point of the other
+	return Lower[:-1] + Upper[:-1]
+
+
+def farthestPair(Point_List):
+	"""Finds the two points that are furthest apart using rotating calipers on the convex hull
+
+	Args:
+		Point_List ([tuple]): X and Y coordinates of each point
+
+	Returns:
+		(tuple, tuple, float): The two furthest apart points and the distance between them.
+			The points are None if there are less than two distinct points
+	"""
+	Hull = convexHull(Point_List)
+	if len(Hull) < 2:
+		return None, None, 0.0
+	if len(Hull) == 2:
+		return Hull[0], Hull[1], distanceBetweenPoints(Hull[0], Hull[1])
+	MaxDistance = 0.0
+	Pair = (None, None)
+	NumPoints = len(Hull)
+	# Index of the point on the opposite side of the hull to the current edge
+	Opposite = 1
+	for Index in range(NumPoints):
+		Start = Hull[Index]
+		End = Hull[(Index + 1) % NumPoints]
+		# Advances the opposite point while it gets further from the edge
+		while (abs(cross(Start, End, Hull[(Opposite + 1) % NumPoints]))
+				> abs(cross(Start, End, Hull[Opposite]))):
+			Opposite = (Opposite + 1) % NumPoints
+		# The furthest pair is always an antipodal pair of an edge point and the opposite point
+		for Point in (Start, End):
+			Distance = distanceBetweenPoints(Point, Hull[Opposite])
+			if Distance > MaxDistance:
+				MaxDistance = Distance
+				Pair = (Point, Hull[Opposite])
+	return Pair[0], Pair[1], MaxDistance
+
+
+def minAreaRectangle(Point_List):
+	"""Finds the smallest rectangle that encloses the points using rotating calipers on the convex hull
+
+	One side of the smallest rectangle always lies along an edge of the hull, so each edge is checked 
+	while the calipers on the other three sides are moved round the hull with it
+
+	Args:
+		Point_List ([tuple]): X and Y coordinates of each point
+
+	Returns:
+		(float, float): Angle of the sides of the rectangle in degrees from 0 to 90, measured the same way 
+			as math.atan2(Y, X), and the area of the rectangle. Rotating the points by minus the angle 
+			aligns the rectangle with the axes
+	"""
+	Hull = convexHull(Point_List)
+	if len(Hull) < 3:
+		# Points on a line fit in a rectangle with no area along the line
+		if len(Hull) == 2:
+			Angle = math.degrees(math.atan2(Hull[1][1] - Hull[0][1], Hull[1][0] - Hull[0][0]))
+			return Angle % 90, 0.0
+		return 0.0, 0.0
+	NumPoints = len(Hull)
+
+	def project(Index, Direction):
+		"""Projects a hull point onto a unit direction"""
+		return Hull[Index % NumPoints][0] * Direction[0] + Hull[Index % NumPoints][1] * Direction[1]
+
+	MinArea = float("Infinity")
+	BestAngle = 0.0
+	# Indexes of the points touching the far, top and near calipers
+	Far = Top = Near = None
+	for Index in range(NumPoints):
+		Start = Hull[Index]
+		End = Hull[(Index + 1) % NumPoints]
+		Length = distanceBetweenPoints(Start, End)
+		# Unit vector along the edge and the normal pointing into the hull
+		Along = ((End[0] - Start[0]) / Length, (End[1] - Start[1]) / Length)
+		Normal = (-Along[1], Along[0])
+		if Far is None:
+			# The first edge finds the calipers by checking every point
+			Far = max(range(NumPoints), key=lambda Point: project(Point, Along))
+			Top = max(range(NumPoints), key=lambda Point: project(Point, Normal))
+			Near = min(range(NumPoints), key=lambda Point: project(Point, Along))
+		else:
+			# The calipers only move forwards round the hull as the edge rotates
+			while project(Far + 1, Along) > project(Far, Along):
+				Far = (Far + 1) % NumPoints
+			while project(Top + 1, Normal) > project(Top, Normal):
+				Top = (Top + 1) % NumPoints
+			while project(Near + 1, Along) < project(Near, Along):
+				Near = (Near + 1) % NumPoints
+		Width = project(Far, Along) - project(Near, Along)
+		Height = project(Top, Normal) - (Start[0] * Normal[0] + Start[1] * Normal[1])
+		if Width * Height < MinArea:
+			MinArea = Width * Height
+			BestAngle = math.degrees(math.atan2(Along[1], Along[0])) % 90
+	return BestAngle, MinArea
@@ -0,0 +1,211 @@
+## Shared indexer for tif images split into channels with _wN in their filenames
+## Copy this file to Fiji.app/jars/Lib so it can be imported by the macros
+
+import csv
+import os
+import re
+import struct
+
+# Manifest kept in each indexed directory so an unchanged directory is not listed again
+MANIFEST_NAME = '.ImageIndex.csv'
+MANIFEST_COLUMNS = ['FileName', 'Size', 'MTime', 'Width', 'Height']
+
+
+def splitWavelength(FileName):
+	"""Splits a tif filename into the name shared by its image set and its wavelength
+
+	The wavelength is the last part of the name between underscores that starts with w1 to w9
+
+	Args:
+		FileName (str): Name of the file
+
+	Returns:
+		(str, str): Name of the image set and the wavelength, e.g. w1. Both are None if the file
+			is not a tif, and the wavelength is None if the name does not have one
+	"""
+	if not re.search(r'\.tif{1,2}$', FileName, flags=re.IGNORECASE):
+		return None, None
+	Parts = re.sub(r'\.tif{1,2}$', '', FileName, flags=re.IGNORECASE).split('_')
+	for Index in range(len(Parts) - 1, -1, -1):
+		if re.match('w[1-9]', Parts[Index], flags=re.IGNORECASE):
+			return '_'.join(Parts[:Index] + Parts[Index + 1:]), Parts[Index]
+	return '_'.join(Parts), None
+
+
+def readTiffSize(Path):
+	"""Reads the width and height of the first image in a tif file from its header
+
+	Args:
+		Path (str): Path of the tif file
+
+	Returns:
+		(int, int): Width and height in pixels, both are None if the header cannot be read
+	"""
+	TiffFile = open(Path, 'rb')
+	try:
+		Header = TiffFile.read(16)
+		if Header[:2] == b'II':
+			Order = '<'
+		elif Header[:2] == b'MM':
+			Order = '>'
+		else:
+			return None, None
+		Version = struct.unpack(Order + 'H', Header[2:4])[0]
+		# Classic tif files have 32 bit offsets and BigTIFF files have 64 bit offsets
+		if Version == 42:
+			Offset = struct.unpack(Order + 'I', Header[4:8])[0]
+			CountFormat, EntrySize, OffsetFormat = 'H', 12, 'I'
+		elif Version == 43:
+			Offset = struct.unpack(Order + 'Q', Header[8:16])[0]
+			CountFormat, EntrySize, OffsetFormat = 'Q', 20, 'Q'
+		else:
+			return None, None
+		TiffFile.seek(Offset)
+		CountSize = struct.calcsize(CountFormat)
+		Count = struct.unpack(Order + CountFormat, TiffFile.read(CountSize))[0]
+		Entries = TiffFile.read(Count * EntrySize)
+		Size = {}
+		for Entry in range(Count):
+			Start = Entry * EntrySize
+			Tag, Type = struct.unpack(Order + 'HH', Entries[Start:Start + 4])
+			# 256 is the width and 257 is the height, stored as a short, long or long8
+			if Tag in (256, 257):
+				ValueStart = Start + 4 + struct.calcsize(OffsetFormat)
+				ValueFormat = {3: 'H', 4: 'I', 16: 'Q'}.get(Type)
+				if ValueFormat is not None:
+					ValueEnd = ValueStart + struct.calcsize(ValueFormat)
+					Size[Tag] = struct.unpack(Order + ValueFormat, Entries[ValueStart:ValueEnd])[0]
+		return Size.get(256), Size.get(257)
+	except (struct.error, IOError):
+		return None, None
+	finally:
+		TiffFile.close()
+
+
+class ImageIndex(object):
+	"""Tif files in a directory grouped into image sets by the name shared by their wavelengths"""
+	def __init__(self, Directory, Use_Manifest=True):
+		"""Indexes the directory, reusing the manifest without listing the directory if nothing has been added or removed
+
+		Args:
+			Directory (str): Directory containing the images
+			Use_Manifest (bool, optional): Reuses and updates the manifest in the directory. Defaults to True.
+		"""
+		self.Directory = Directory
+		# {str: {str: str}}: Filename of each wavelength of each image set
+		self.Sets = {}
+		# {str: (int, float, int, int)}: Size in bytes, modified time, width and height of each tif file
+		self.Files = {}
+		# [str]: Tif files without a wavelength in their name
+		self.Unmatched = []
+		# Adding, removing or renaming a file changes the modified time of the directory
+		DirectoryMTime = os.stat(Directory).st_mtime
+		Manifest, ManifestMTime = {}, None
+		if Use_Manifest:
+			Manifest, ManifestMTime = self._readManifest()
+		if ManifestMTime == DirectoryMTime:
+			# The directory is unchanged so the files are neither listed nor looked at
+			self.Files = Manifest
+		else:
+			self._scan(Manifest)
+		for FileName in sorted(self.Files.keys()):
+			Stem, Wavelength = splitWavelength(FileName)
+			if Wavelength is None:
+				self.Unmatched.append(FileName)
+				continue
+			if Stem not in self.Sets:
+				self.Sets[Stem] = {}
+			self.Sets[Stem][Wavelength] = FileName
+		if Use_Manifest and ManifestMTime != DirectoryMTime:
+			# Creating the manifest changes the modified time of the directory so the next index lists it once more
+			self._writeManifest(DirectoryMTime)
+
+	def _scan(self, Manifest):
+		"""Lists the directory and reads the size of any tif file that is new or has changed
+
+		Args:
+			Manifest ({str: (int, float, int, int)}): Records from the last index of the directory
+		"""
+		for FileName in os.listdir(self.Directory):
+			Stem, Wavelength = splitWavelength(FileName)
+			if Stem is None:
+				continue
+			Stats = os.stat(os.path.join(self.Directory, FileName))
+			Record = Manifest.get(FileName)
+			if Record is None or Record[0] != Stats.st_size or Record[1] != Stats.st_mtime:
+				Width, Height = readTiffSize(os.path.join(self.Directory, FileName))
+				Record = (Stats.st_size, Stats.st_mtime, Width, Height)
+			self.Files[FileName] = Record
+
+	def _readManifest(self):
+		"""Reads the manifest saved by the last index of the directory
+
+		Returns:
+			({str: (int, float, int, int)}, float): Size in bytes, modified time, width and height of each tif file
+				and the modified time of the directory when it was indexed. Empty and None if there is no manifest 
+				or it cannot be read
+		"""
+		Manifest = {}
+		try:
+			ManifestFile = open(os.path.join(self.Directory, MANIFEST_NAME), 'rb')
+		except IOError:
+			return Manifest, None
+		try:
+			Reader = csv.reader(ManifestFile)
+			DirectoryRow = next(Reader, None)
+			if DirectoryRow is None or DirectoryRow[0] != 'DirectoryMTime' or next(Reader, None) != MANIFEST_COLUMNS:
+				return {}, None
+			DirectoryMTime = float(DirectoryRow[1])
+			for Row in Reader:
+				Width = int(Row[3]) if Row[3] != '' else None
+				Height = int(Row[4]) if Row[4] != '' else None
+				Manifest[Row[0]] = (int(Row[1]), float(Row[2]), Width, Height)
+		except (csv.Error, ValueError, IndexError):
+			# A damaged manifest is ignored so every file is read again
+			return {}, None
+		finally:
+			ManifestFile.close()
+		return Manifest, DirectoryMTime
+
+	def _writeManifest(self, DirectoryMTime):
+		"""Saves the manifest to the directory, skipped if the directory cannot be written to
+
+		Args:
+			DirectoryMTime (float): Modified time of the directory the records are from
+		"""
+		try:
+			ManifestFile = open(os.path.join(self.Directory, MANIFEST_NAME), 'wb')
+		except IOError:
+			return
+		try:
+			Writer = csv.writer(ManifestFile)
+			Writer.writerow(['DirectoryMTime', repr(DirectoryMTime)])
+			Writer.writerow(MANIFEST_COLUMNS)
+			for FileName in sorted(self.Files.keys()):
+				Size, MTime, Width, Height = self.Files[FileName]
+				Writer.writerow([FileName, Size, repr(MTime),
+								 '' if Width is None else Width, '' if Height is None else Height])
+		finally:
+			ManifestFile.close()
+
+	def path(self, FileName):
+		"""Gets the full path of a file in the index
+
+		Args:
+			FileName (str): Name of the file
+
+		Returns:
+			str: Path of the file
+		"""
+		return os.path.join(self.Directory, FileName)
+
+	def wavelengths(self):
+		"""Gets every wavelength in the index
+
+		Returns:
+			[str]: Wavelengths in order
+		"""
+		Wavelengths = set()
+		for Channels in self.Sets.values():
+			Wavelengths.update(Channels.keys())
+		return sorted(Wavelengths, key=lambda Wavelength: Wavelength.lower())
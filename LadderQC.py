@@ -1,93 +1,66 @@
-#@ File (label="Input Image", style="file") InputImage
+#@ File (label="Input Image or Directory", style="both") InputImage
 #@ File (label="Output Directory", style="directory") OutputDirectory
+#@ Integer (label="Worker Threads", value=1) Workers
+#@ String (label="Mode", choices={"XZ Line", "Per Bead"}, value="XZ Line") Mode
+#@ String (label="Axial Peak Fit", choices={"Gaussian", "Parabola", "None"}, value="Gaussian") PeakFit
 
 # Python modules
-import copy, re, os
+import os
 from collections import Counter
 # Java modules
+from java.lang import Exception as JavaException
 from java.lang import Math
+from java.awt import Rectangle
+from java.util.concurrent import Callable, Executors
 # ImageJ modules
 from ij import IJ
-from ij import WindowManager
+from ij import ImagePlus
 from ij.io import FileSaver
 from ij.gui import Line
-from ij.gui import Overlay
-from ij.gui import Roi
 from ij.measure import Measurements
 from ij.measure import ResultsTable
 from ij.plugin import ZProjector
-from ij.plugin.filter import Analyzer
+from ij.plugin.filter import MaximumFinder
+from ij.plugin.filter import ParticleAnalyzer
+from ij.process import FloatProcessor
+from ij.process import ImageProcessor
 # Bioformats modules
+from loci.formats import ImageReader
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
+# Shared geometry module, needs to be in Fiji.app/jars/Lib
+from Geometry import farthestPair
 
 
-def analyzeParticles(
+def getParticleCentroids(
 		Binary_Image, 
-		Size_Setting, 
-		Circularity_Setting):
-	"""Runs analyze particles on the binary image, returning the ROI
-
-	Args:
-		Binary_Image (ij.ImagePlus): Segmented binary image
-		Size_Setting (str): Min/Max size settings for analyse particles
-		Circularity_Setting (str): Min/Max circularity settings for analyse particles
-
-	Returns:
-		[PolygonRoi]: Outputted Rois
-	"""	
-
-	# Defines analyse particles settings
-	AnalyzeParticlesSettings = (
-		"size=" 
-		+ Size_Setting 
-		+ " circularity=" 
-		+ Circularity_Setting 
-		+ " clear overlay exclude"
-	)
-	# Runs the analyze particles command to get ROI. 
-	# Done by adding to the overlay in order to not have ROIManger shown to user
-	IJ.run(Binary_Image, "Analyze Particles...", AnalyzeParticlesSettings)
-	# Gets the Overlayed ROIs from analyze particles
-	Overlayed_Rois = Binary_Image.getOverlay()
-	# Takes the overlay and turns it into an array of ROI
-	RoiList = Overlayed_Rois.toArray()
-	# Removes this overlay to clean up the image
-	IJ.run(Binary_Image, "Remove Overlay", "")
-	return RoiList
+		Min_Size):
+	"""Runs the particle analyzer on the binary image, returning the centroid of each particle
 
-
-def getRoiMeasurements(SampleRoi, Image, Measurement_Options):
-	"""Gets the given measurements of the provided Roi for the given image
+	Uses its own results table so several images can be analysed at once
 
 	Args:
-		SampleRoi (ij.gui.Roi): Roi to be analysed
-		Image (ij.ImagePlus): Image to be analysed
-		Measurement_Options ([str]): ij.Measure.Measurements to be taken
+		Binary_Image (ij.ImagePlus): Segmented binary image without a scale
+		Min_Size (float): Minimum size of the particles in pixels
 
 	Returns:
-		[float]: List of measurements in same order as Measurement_Options
-	"""	
-	
-	# Initialises a new empty results table
+		[tuple]: X and Y coordinates of the centroid of each particle
+	"""
 	RTable = ResultsTable()
-	# Initialises an Analyzer object using 
-	# the image and the empty results table
-	An = Analyzer(Image, RTable)
-	# Selects the roi on the image
-	Image.setRoi(SampleRoi)
-	# Takes the measurements
-	An.measure()
-	# Takes the desired results from 
-	# the results table and adds to a list
-	OutputList = []
-	for Option in Measurement_Options:
-		OutputList.append(RTable.getValue(Option, 0))
-	# Clears the results table
-	RTable.reset()
-	# Clears the roi from the image
-	Image.resetRoi()
-	return OutputList
+	# Particles touching the edge are excluded as their centroid is not accurate
+	Analyzer = ParticleAnalyzer(
+		ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES, 
+		Measurements.CENTROID, 
+		RTable, 
+		Min_Size, 
+		float("Infinity"), 
+		0.0, 
+		1.0
+	)
+	Analyzer.setHideOutputImage(True)
+	Analyzer.analyze(Binary_Image)
+	# Must be tuples to be hashable in dictionary
+	return [(RTable.getValue("X", Row), RTable.getValue("Y", Row)) for Row in range(RTable.size())]
 
 
 def distanceBetweenPoints(X1, Y1, X2, Y2):
@@ -127,7 +100,79 @@ def closestPoint(Point, Point_List):
 			MinDistance = Distance
 			MinPoint = OtherPoint
 	return MinPoint
-	
+
+
+class PointGrid(object):
+	"""Spatial index that buckets points into a grid for nearest neighbour searches"""
+	def __init__(self, Point_List):
+		"""Builds the grid once over all of the points
+
+		Args:
+			Point_List ([tuple]): X and Y coordinates of each point
+		"""
+		self.Point_List = Point_List
+		XList = [Point[0] for Point in Point_List]
+		YList = [Point[1] for Point in Point_List]
+		self.MinX = min(XList)
+		self.MinY = min(YList)
+		Width = max(XList) - self.MinX
+		Height = max(YList) - self.MinY
+		# Sizes the cells so there is roughly one point per cell
+		self.CellSize = max(Math.sqrt((Width * Height) / len(Point_List)), 1.0)
+		self.Columns = int(Width / self.CellSize) + 1
+		self.Rows = int(Height / self.CellSize) + 1
+		# Stores the index of each point so the original order can be used to break ties
+		self.Cells = {}
+		for Index, Point in enumerate(Point_List):
+			self.Cells.setdefault(self.getCell(Point), []).append(Index)
+
+	def getCell(self, Point):
+		"""Gets the grid cell that contains the point
+
+		Args:
+			Point (tuple): X and Y coordinates of the point
+
+		Returns:
+			tuple: Column and row of the cell
+		"""
+		return (int((Point[0] - self.MinX) / self.CellSize), int((Point[1] - self.MinY) / self.CellSize))
+
+	def closestPoint(self, Index):
+		"""Finds the closest other point to the point at the given index
+
+		Args:
+			Index (int): Index of the point in the list used to build the grid
+
+		Returns:
+			tuple: X and Y coordinates of the closest point, same as closestPoint with the point removed
+		"""
+		Point = self.Point_List[Index]
+		Column, Row = self.getCell(Point)
+		# Distance and index of the closest point found so far, the index breaks ties in list order
+		Best = (float("Infinity"), None)
+		Ring = 0
+		# Searches rings of cells outwards from the cell of the point
+		while Ring <= max(self.Columns, self.Rows):
+			for CellColumn in range(Column - Ring, Column + Ring + 1):
+				for CellRow in range(Row - Ring, Row + Ring + 1):
+					# Only the edge of the ring has not already been searched
+					if max(abs(CellColumn - Column), abs(CellRow - Row)) != Ring:
+						continue
+					for OtherIndex in self.Cells.get((CellColumn, CellRow), ()):
+						if OtherIndex == Index:
+							continue
+						OtherPoint = self.Point_List[OtherIndex]
+						Distance = distanceBetweenPoints(Point[0], Point[1], OtherPoint[0], OtherPoint[1])
+						if (Distance, OtherIndex) < Best:
+							Best = (Distance, OtherIndex)
+			# Points in the further rings are at least this far away so cannot be closer
+			if Best[0] < Ring * self.CellSize:
+				break
+			Ring += 1
+		if Best[1] is None:
+			return (None, None)
+		return self.Point_List[Best[1]]
+
 
 def roundToBase(Number, Base):
 	"""Rounds the given number to the nearest multiple of the given base
@@ -157,39 +202,153 @@ def getAngleBetweenPoints(Point1, Point2):
 	return Angle
 
 
-def selectWindow(Pattern):
-	"""Selects the window with the given pattern in the title
+def getLadderAngle(FirstPoint, SecondPoint):
+	"""Gets the angle of the line between two points from left to right
 
 	Args:
-		Pattern (string): regex pattern to match
+		FirstPoint (tuple): X and Y coordinates of first point
+		SecondPoint (tuple): X and Y coordinates of second point
 
 	Returns:
-		boolean: Whether the given window was found and selected
-	"""	
-	TitleList = WindowManager.getImageTitles()
-	for Title in TitleList:
-		if re.match(Pattern, Title):
-			IJ.selectWindow(Title)
-			return True
-	return False
+		(float, int): Angle between the two points in degrees and the angle rounded to the nearest 5 degrees 
+			between 0 and 180
+	"""
+	# Has to be from left to right as the lines can be in either direction
+	if FirstPoint[0] <= SecondPoint[0]:
+		LadderAngle = getAngleBetweenPoints(FirstPoint, SecondPoint)
+	else:
+		LadderAngle = getAngleBetweenPoints(SecondPoint, FirstPoint)
+	RoundedLadderAngle = abs(roundToBase(LadderAngle, 5))
+	if RoundedLadderAngle >= 180:
+		RoundedLadderAngle -= 180
+	return LadderAngle, RoundedLadderAngle
+
+
+def furthestParallelPair(LadderList, ModeAngle):
+	"""Checks every pair of points to find the furthest apart that are at the mode angle
+
+	Args:
+		LadderList ([tuple]): X and Y coordinates of the points in the ladder
+		ModeAngle (int): Rounded angle of the ladder
+
+	Returns:
+		(tuple, tuple, float): The two furthest apart points and the unrounded angle between them
+	"""
+	MaxLadderDistance = 0
+	FurthestPair = (None, None, None)
+	for Index, FirstPoint in enumerate(LadderList):
+		# Each pair only needs to be checked once
+		for SecondPoint in LadderList[Index + 1:]:
+			LadderAngle, RoundedLadderAngle = getLadderAngle(FirstPoint, SecondPoint)
+			LadderDistance = distanceBetweenPoints(FirstPoint[0], FirstPoint[1], SecondPoint[0], SecondPoint[1])
+			# If the angle is the same as the mode angle and the distance is greater than the current max
+			# Then these are the new furthest apart points
+			if RoundedLadderAngle == ModeAngle and LadderDistance > MaxLadderDistance:
+				FurthestPair = (FirstPoint, SecondPoint, LadderAngle)
+				MaxLadderDistance = LadderDistance
+	return FurthestPair
+
+
+def distanceToEdge(X, Y, DX, DY, Width, Height):
+	"""Gets how far a point can move in a direction before leaving the image
+
+	Args:
+		X (float): X coordinate of the point
+		Y (float): Y coordinate of the point
+		DX (float): X component of the unit direction
+		DY (float): Y component of the unit direction
+		Width (int): Width of the image
+		Height (int): Height of the image
+
+	Returns:
+		float: Distance to the edge of the image in pixels
+	"""
+	Distance = float("Infinity")
+	if DX > 0:
+		Distance = min(Distance, (Width - 1 - X) / DX)
+	elif DX < 0:
+		Distance = min(Distance, -X / DX)
+	if DY > 0:
+		Distance = min(Distance, (Height - 1 - Y) / DY)
+	elif DY < 0:
+		Distance = min(Distance, -Y / DY)
+	return max(Distance, 0)
+
+
+def resliceAlongLine(Imp, SampleLine, Margin):
+	"""Interpolates the intensities along a line in every Z plane into an XZ image
+
+	Only the pixels along the line are read so the stack does not need to be rotated
+
+	Args:
+		Imp (ij.ImagePlus): Z stack to sample
+		SampleLine (ij.gui.Line): Line to sample along
+		Margin (float): Distance in pixels to extend the line by at each end, limited to the image
+
+	Returns:
+		ij.ImagePlus: XZ image with a row for each Z plane, calibrated the same as Reslice
+	"""
+	X1, Y1, X2, Y2 = SampleLine.x1d, SampleLine.y1d, SampleLine.x2d, SampleLine.y2d
+	Length = distanceBetweenPoints(X1, Y1, X2, Y2)
+	# Unit vector along the line
+	DX = (X2 - X1) / Length
+	DY = (Y2 - Y1) / Length
+	Width = Imp.getWidth()
+	Height = Imp.getHeight()
+	# Extends the line at each end without going outside of the image
+	StartMargin = min(Margin, distanceToEdge(X1, Y1, -DX, -DY, Width, Height))
+	EndMargin = min(Margin, distanceToEdge(X2, Y2, DX, DY, Width, Height))
+	StartX, StartY = X1 - DX * StartMargin, Y1 - DY * StartMargin
+	EndX, EndY = X2 + DX * EndMargin, Y2 + DY * EndMargin
+
+	Stack = Imp.getStack()
+	Profiles = []
+	for Z in range(1, Imp.getNSlices() + 1):
+		Processor = Stack.getProcessor(Imp.getStackIndex(Imp.getC(), Z, Imp.getT()))
+		Processor.setInterpolationMethod(ImageProcessor.BILINEAR)
+		# Samples roughly one point per pixel along the line
+		Profiles.append(Processor.getLine(StartX, StartY, EndX, EndY))
+
+	XZProcessor = FloatProcessor(len(Profiles[0]), len(Profiles))
+	for Row, Profile in enumerate(Profiles):
+		for Column, Value in enumerate(Profile):
+			XZProcessor.setf(Column, Row, Value)
+	XZImp = ImagePlus("Reslice of " + Imp.getTitle(), XZProcessor)
+	# Rows are Z planes so have the Z depth as their height
+	XZCalibration = Imp.getCalibration().copy()
+	XZCalibration.pixelHeight = XZCalibration.pixelDepth
+	XZCalibration.pixelDepth = 1
+	XZImp.setCalibration(XZCalibration)
+	return XZImp
+
 
 def main(
 		input_image,
-		output_directory):
-	# This section sets the measurements that will be used
-	AnalyzerClass = Analyzer()
-	# Gets original measurements to reset later
-	OriginalMeasurements = AnalyzerClass.getMeasurements()
-
-	# Sets the measurements to be used
-	AnalyzerClass.setMeasurements(
-		Measurements.SHAPE_DESCRIPTORS 
-		+ Measurements.CENTROID
-	)
+		output_directory,
+		peak_fit="Gaussian",
+		mode="XZ Line",
+		workers=1):
+	"""Measures the axial step between the beads of a ladder image
+
+	Does not use any windows or the global results table so several images can be run at once
+
+	Args:
+		input_image (java.io.File): Ladder image
+		output_directory (java.io.File): Directory to save the XZ image and results to
+		peak_fit (str, optional): Peak fitted along Z to each maxima for sub-plane positions, 
+			either "Gaussian", "Parabola" or "None". Defaults to "Gaussian".
+		mode (str, optional): "XZ Line" measures the beads along a single XZ line through the ladder, 
+			"Per Bead" localises each bead in its own sub-volume. Defaults to "XZ Line".
+		workers (int, optional): Number of beads to localise at once in per bead mode. Defaults to 1.
 
+	Returns:
+		(str, int, float, float, float): File name, number of beads, mean and standard deviation 
+			of the axial difference between neighbouring beads, and the fitted slope of the ladder 
+			which is NaN in XZ line mode
+	"""
 	# Gets the needed paths and filenames for input and output
 	FileName = input_image.getName()
-	FileNameNoExtension = ".".join(FileName.split("."))[:-1]
+	FileNameNoExtension = ".".join(FileName.split(".")[:-1])
 	OutputPath = output_directory.getPath()
 
 	# Imports the image using Bioformats-------------------v
@@ -203,6 +362,10 @@ def main(
 
 	Calibration = Imp.getCalibration()
 	ZDepth = Calibration.pixelDepth
+	# Sigma of the gaussian blur used to smooth the XZ image
+	BlurSigma = 6
+	# Number of Z planes either side of each maxima used to fit the peak
+	FitHalfWidth = 3
 
 	# Max intensity of the image to get all of the ladder
 	Projected = ZProjector.run(Imp, "max")
@@ -211,32 +374,21 @@ def main(
 	# Thresholds the image to get the ladder
 	IJ.setAutoThreshold(Projected, "Default dark")
 	IJ.run(Projected, "Convert to Mask", "")
-	# Runs analyze particles to get a list of ROIs
-	RoiList = analyzeParticles(Projected, "10-Infinity", "0.00-1.00")
-
-	# String needed to get the centroid of the ROI
-	CentroidString = ["X", "Y"]
-
-	# Gets the centroid of each ROI and adds to a list-------------------v
-	PointList = []
-	for ThisRoi in RoiList:
-		Centroid = getRoiMeasurements(ThisRoi, Projected, CentroidString)
-		# Must be a tuple to be hashable in dictionary
-		PointList.append(tuple(Centroid))
-	#--------------------------------------------------------------------^
+	# Runs the particle analyzer to get the centroid of each particle
+	PointList = getParticleCentroids(Projected, 10)
+	Projected.close()
 
 	# For each point it will get the angle of the line between it and the closest point-v
 	# This will be used to eliminate the points that are not part of the ladder
 	# As these points will all be running parallel to each other
 	PointDict = {}
+	NearestDict = {}
 	RoundedAngleList = []
+	# Builds the spatial index once so each search only looks at nearby points
+	Grid = PointGrid(PointList)
 	for Index, PointItem in enumerate(PointList):
-		# Need to deep copy the list to avoid modifying the original
-		InputList = copy.copy(PointList)
-		# Need to remove the current point from the list to avoid finding itself
-		del InputList[Index]
-		# Finds the closest point to the current point
-		ClosestPoint = closestPoint(PointItem, InputList)
+		# Finds the closest point to the current point, excluding itself
+		ClosestPoint = Grid.closestPoint(Index)
 		# Gets the angle between the two points
 		LineAngle = getAngleBetweenPoints(PointItem, ClosestPoint)
 		# Rounds the angle to the nearest 5 degrees
@@ -246,6 +398,7 @@ def main(
 			RoundedAngle -= 180
 		# Adds the angle to a dictionary with the point as the key
 		PointDict[PointItem] = RoundedAngle
+		NearestDict[PointItem] = distanceBetweenPoints(PointItem[0], PointItem[1], ClosestPoint[0], ClosestPoint[1])
 		# Adds the angle to a list of all angles to find the mode
 		RoundedAngleList.append(RoundedAngle)
 	#-----------------------------------------------------------------------------------^
@@ -261,80 +414,53 @@ def main(
 	#-------------------------------------------------^
 
 	# Gets the two points that are furthest apart but are still parallel to each other--------------------------v
-	MaxLadderDistance = 0
-	for Index, FirstPoint in enumerate(LadderList):
-		# Need to deep copy the list to avoid modifying the original
-		SecondList = copy.copy(LadderList)
-		# Need to remove the current point from the list to avoid finding itself
-		del SecondList[Index]
-		# Loops though every other list of points to find the furthest apart
-		for SecondPoint in SecondList:
-			# Gets the angle between the two points, has to be absolute as the lines can be in either direction
-			if FirstPoint[0] <= SecondPoint[0]:
-				LadderAngle = getAngleBetweenPoints(FirstPoint, SecondPoint)
-			else:
-				LadderAngle = getAngleBetweenPoints(SecondPoint, FirstPoint)
-			# Gets the distance between the two points
-			LadderDistance = distanceBetweenPoints(FirstPoint[0], FirstPoint[1], SecondPoint[0], SecondPoint[1])
-			# Rounds the angle to the nearest 5 degrees
-			RoundedLadderAngle = abs(roundToBase(LadderAngle, 5))
-			if RoundedLadderAngle >= 180:
-				RoundedLadderAngle -= 180
-			# If the angle is the same as the mode angle and the distance is greater than the current max
-			# Then these are the new furthest apart points
-			if RoundedLadderAngle == ModeAngle and LadderDistance > MaxLadderDistance:
-				FeducialLine = Line(FirstPoint[0], FirstPoint[1], SecondPoint[0], SecondPoint[1])
-				# This angle is not rounded as it is used to rotate the image
-				FeducialAngle = LadderAngle
-				MaxLadderDistance = LadderDistance
+	# The beads are collinear so the furthest pair of all the ladder points is normally the two ends of the ladder
+	FirstPoint, SecondPoint, MaxLadderDistance = farthestPair(LadderList)
+	LadderAngle, RoundedLadderAngle = getLadderAngle(FirstPoint, SecondPoint)
+	# If stray points make the furthest pair not parallel to the ladder then every pair is checked
+	if RoundedLadderAngle != ModeAngle:
+		FirstPoint, SecondPoint, LadderAngle = furthestParallelPair(LadderList, ModeAngle)
+	# Orders the points from left to right so the XZ image is in the same direction as the image
+	FirstPoint, SecondPoint = sorted([FirstPoint, SecondPoint])
+	FeducialLine = Line(FirstPoint[0], FirstPoint[1], SecondPoint[0], SecondPoint[1])
 	#-----------------------------------------------------------------------------------------------------------^
 
-	# Need to use an overlay so it will rotate with the image
-	LineOverlay = Overlay(FeducialLine)
-	Imp.setOverlay(LineOverlay)
-	
-	# Rotates the image so the ladder is horizontal
-	IJ.run(Imp, "Arbitrarily...", "angle=" + str(-FeducialAngle) + " interpolate stack")
-	# Gets the Rotated Roi from the overlay
-	RotatedLineOverlay = Imp.getOverlay()
-	RotatedLineRoi = RotatedLineOverlay.get(0)
-	
-	# Removes the overlay to clean up the image
-	Imp.setOverlay(None)
-
-	# Gets the centroid of the rotated line
-	LineCentroid = getRoiMeasurements(RotatedLineRoi, Projected, CentroidString)
-
-	# Gets the width of the image
-	Width = Imp.getWidth()
-	# Creates a box roi that is 1 pixel high and the width of the image centred on the line centroid
-	BoxRoi = Roi(0, LineCentroid[1], Width, 1)
-
-	# Crops the image to the single line
-	Imp.setRoi(BoxRoi)
-	LineImage = Imp.crop("stack")
+	if mode == "Per Bead":
+		# Sub-volumes are half the bead spacing so they do not overlap the neighbouring beads
+		Spacings = sorted([NearestDict[PointItem] for PointItem in LadderList])
+		Radius = max(2, int(Spacings[len(Spacings) // 2] / 2))
+		BeadResults, Slope = analyzeBeads(Imp, LadderList, FeducialLine, Radius, FitHalfWidth, peak_fit, workers)
+		Imp.close()
+		BeadResults.saveAs(os.path.join(OutputPath, FileNameNoExtension + "_Beads.csv"))
+		AxialDiffList = [BeadResults.getValue("AxialDiff", Row) for Row in range(1, BeadResults.size())]
+		return (FileName, BeadResults.size()) + meanAndSD(AxialDiffList) + (Slope,)
+
+	# Samples along the ladder in every Z plane to get the XZ image similar to orthagonal view
+	# The line is extended by the blur so the beads at the ends are not cut off
+	SlicedImp = resliceAlongLine(Imp, FeducialLine, 3 * BlurSigma)
 	# Closes the original image to save memory
 	Imp.close()
 
-	# Runs the reslice command to get the XZ image similar to orthagonal view
-	IJ.run(LineImage, "Reslice [/]...", "output=" + str(ZDepth) +" start=Top avoid")
-
-	# Gets the resliced image
-	selectWindow("Reslice ")
-	OriginalSlicedImp = IJ.getImage()
-	# Duplicates the image to only get one slice
-	SlicedImp = OriginalSlicedImp.crop()
-	# Close the original image to save memory
-	OriginalSlicedImp.close()
-
 	# Performs gaussian blur to smooth the image
-	IJ.run(SlicedImp, "Gaussian Blur...", "sigma=6")
+	IJ.run(SlicedImp, "Gaussian Blur...", "sigma=" + str(BlurSigma))
 	# Gets the statistics which includes the minimum and maximum intensity of the image
 	ImpStats = SlicedImp.getStatistics()
 	# Sets the prominence for the find maxima command to be half the difference between the min and max intensity
-	Prominence = str((ImpStats.max - ImpStats.min)/2)
-	# Finds the maxima in the image and outputs to a results table
-	IJ.run(SlicedImp, "Find Maxima...", "prominence=" + Prominence + " output=List")
+	Prominence = (ImpStats.max - ImpStats.min)/2
+	# Finds the maxima in the image, the same as Find Maxima with a list output
+	Maxima = MaximumFinder().getMaxima(SlicedImp.getProcessor(), Prominence, False, False)
+	# Refines the Z position of each maxima to between the planes
+	if peak_fit != "None":
+		FitList = fitAxialPeaks(SlicedImp.getProcessor(), Maxima, FitHalfWidth, peak_fit, ImpStats.min)
+	# Adds the maxima to a new results table rather than the global one
+	MaximaResults = ResultsTable()
+	for Index in range(Maxima.npoints):
+		MaximaResults.incrementCounter()
+		MaximaResults.addValue("X", Maxima.xpoints[Index])
+		MaximaResults.addValue("Y", Maxima.ypoints[Index])
+		if peak_fit != "None":
+			MaximaResults.addValue("FitY", FitList[Index][0])
+			MaximaResults.addValue("FitResidual", FitList[Index][1])
 
 	# Resets the contrast for easier viewing
 	SlicedImp.resetDisplayRange()
@@ -342,32 +468,330 @@ def main(
 	FileSaver(SlicedImp).saveAsTiff(os.path.join(OutputPath, FileNameNoExtension + "_XZ.tif"))
 	SlicedImp.close()
 
-	# Gets the results table and copies it so the displayed one can be closed
-	Results = ResultsTable().getResultsTable()
-	MaximaResults = Results.clone()
-	# Needs to reset the table to avoid dialog asking to save
-	Results.reset()
-	# Closes the results table
-	WindowManager.getWindow("Results").close()
-
-	# Calculates the axial step size for each maxima
+	# Calculates the axial step size for each maxima, using the fitted position if there is one
+	YColumn = "Y" if peak_fit == "None" else "FitY"
 	for Row in range(0, MaximaResults.size()):
-		AxialStep = MaximaResults.getValue("Y", Row) * ZDepth
+		AxialStep = MaximaResults.getValue(YColumn, Row) * ZDepth
 		MaximaResults.setValue("AxialStep", Row, AxialStep)
 
 	# Sorts the results table by the X coordinate
 	MaximaResults.sort("X")
 
 	# Calculates the axial difference between each maxima
+	AxialDiffList = []
 	for SortedRow in range(1, MaximaResults.size()):
 		AxialDiff = abs(MaximaResults.getValue("AxialStep", SortedRow) - MaximaResults.getValue("AxialStep", SortedRow - 1))
 		MaximaResults.setValue("AxialDiff", SortedRow, AxialDiff)
+		AxialDiffList.append(AxialDiff)
 
 	# Saves the results table
 	MaximaResults.saveAs(os.path.join(OutputPath, FileNameNoExtension + "_XZ.csv"))
 
-	# Resets the measurements to the original settings
-	AnalyzerClass.setMeasurements(OriginalMeasurements)
+	return (FileName, MaximaResults.size()) + meanAndSD(AxialDiffList) + (float("NaN"),)
+
+
+def getFitWeights(HalfWidth):
+	"""Gets the least squares weights for fitting a parabola to evenly spaced points
+
+	The points are at the same offsets around every maxima so the weights only need to be found once, 
+	each fit is then a weighted sum of the intensities
+
+	Args:
+		HalfWidth (int): Number of points either side of the centre point
+
+	Returns:
+		([float], [float], [float]): Weights for the constant, linear and squared terms at each offset
+	"""
+	Offsets = range(-HalfWidth, HalfWidth + 1)
+	N = len(Offsets)
+	# Odd sums of the offsets are zero as they are symmetric
+	S2 = sum([T * T for T in Offsets])
+	S4 = sum([T * T * T * T for T in Offsets])
+	Determinant = float(N * S4 - S2 * S2)
+	ConstantWeights = [(S4 - S2 * T * T) / Determinant for T in Offsets]
+	LinearWeights = [T / float(S2) for T in Offsets]
+	SquaredWeights = [(N * T * T - S2) / Determinant for T in Offsets]
+	return ConstantWeights, LinearWeights, SquaredWeights
+
+
+def fitPeak(Intensities, Centre, HalfWidth, Weights, Method, Baseline):
+	"""Refines the position of a peak by fitting to the intensities around it
+
+	Args:
+		Intensities ([float]): Evenly spaced intensities containing the peak
+		Centre (int): Index of the maximum intensity of the peak
+		HalfWidth (int): Number of points either side of the centre to fit to
+		Weights (([float], [float], [float])): Least squares weights from getFitWeights
+		Method (str): "Gaussian" fits a parabola to the log of the intensities above the baseline, 
+			"Parabola" fits a parabola to the intensities
+		Baseline (float): Background intensity subtracted before a Gaussian fit
+
+	Returns:
+		(float, float): Sub-point position and root mean square residual of the fit in intensity units. 
+			Peaks that can not be fitted keep their centre with a NaN residual
+	"""
+	# Peaks too close to the ends do not have enough points to fit to
+	if Centre - HalfWidth < 0 or Centre + HalfWidth >= len(Intensities):
+		return float(Centre), float("NaN")
+	Offsets = range(-HalfWidth, HalfWidth + 1)
+	Window = [Intensities[Centre + T] for T in Offsets]
+	if Method == "Gaussian":
+		# A Gaussian is a parabola in log space, so the intensities must be above the baseline
+		Values = [Math.log(max(Intensity - Baseline, 1e-6)) for Intensity in Window]
+	else:
+		Values = Window
+	ConstantWeights, LinearWeights, SquaredWeights = Weights
+	A = sum([W * V for W, V in zip(ConstantWeights, Values)])
+	B = sum([W * V for W, V in zip(LinearWeights, Values)])
+	C = sum([W * V for W, V in zip(SquaredWeights, Values)])
+	# The fit must curve downwards with its peak within the fitted points
+	if C >= 0 or abs(B / (2 * C)) > HalfWidth:
+		return float(Centre), float("NaN")
+	# Residuals are compared in intensity so both methods can be compared
+	SquaredError = 0
+	for T, Intensity in zip(Offsets, Window):
+		Fitted = A + B * T + C * T * T
+		if Method == "Gaussian":
+			Fitted = Math.exp(Fitted) + Baseline
+		SquaredError += (Intensity - Fitted) * (Intensity - Fitted)
+	return Centre - B / (2 * C), Math.sqrt(SquaredError / len(Offsets))
+
+
+def fitAxialPeaks(Processor, Maxima, HalfWidth, Method, Baseline):
+	"""Refines the Z position of each maxima by fitting a peak to the intensities along Z
+
+	Args:
+		Processor (ij.process.ImageProcessor): XZ image with Z along the Y axis
+		Maxima (java.awt.Polygon): Maxima found in the XZ image
+		HalfWidth (int): Number of Z planes either side of the maxima to fit to
+		Method (str): "Gaussian" or "Parabola", see fitPeak
+		Baseline (float): Background intensity subtracted before a Gaussian fit
+
+	Returns:
+		[(float, float)]: Sub-plane Y position and root mean square residual of the fit 
+			for each maxima, see fitPeak
+	"""
+	# The fitting window is the same for every maxima so the weights are only found once
+	Weights = getFitWeights(HalfWidth)
+	Height = Processor.getHeight()
+	FitList = []
+	for Index in range(Maxima.npoints):
+		X = Maxima.xpoints[Index]
+		Y = Maxima.ypoints[Index]
+		# Only the planes in the fitting window are read
+		Column = [0.0] * Height
+		for Z in range(max(Y - HalfWidth, 0), min(Y + HalfWidth + 1, Height)):
+			Column[Z] = Processor.getf(X, Z)
+		FitList.append(fitPeak(Column, Y, HalfWidth, Weights, Method, Baseline))
+	return FitList
+
+
+def localiseBead(Imp, Point, Radius, HalfWidth, Method):
+	"""Localises the axial centre of a bead from the sub-volume around its centroid
+
+	Only the pixels in the sub-volume are read so many beads can be localised at once
+
+	Args:
+		Imp (ij.ImagePlus): Z stack containing the bead
+		Point (tuple): X and Y coordinates of the centroid of the bead
+		Radius (int): Half the width of the sub-volume in pixels
+		HalfWidth (int): Number of Z planes either side of the brightest plane to fit to
+		Method (str): "Gaussian", "Parabola" or "None", see fitPeak
+
+	Returns:
+		(float, float): Sub-plane Z position of the bead, starting at 0, and the residual of the fit
+	"""
+	Box = Rectangle(
+		int(round(Point[0])) - Radius, 
+		int(round(Point[1])) - Radius, 
+		2 * Radius + 1, 
+		2 * Radius + 1
+	).intersection(Rectangle(0, 0, Imp.getWidth(), Imp.getHeight()))
+	Stack = Imp.getStack()
+	# Gets the mean intensity of the sub-volume in each Z plane
+	Profile = []
+	for Z in range(1, Imp.getNSlices() + 1):
+		# The stack makes a new processor each time so setting its roi is safe from several threads
+		Processor = Stack.getProcessor(Imp.getStackIndex(Imp.getC(), Z, Imp.getT()))
+		Processor.setRoi(Box)
+		Profile.append(Processor.getStats().mean)
+	Centre = Profile.index(max(Profile))
+	if Method == "None":
+		return float(Centre), float("NaN")
+	return fitPeak(Profile, Centre, HalfWidth, getFitWeights(HalfWidth), Method, min(Profile))
+
+
+class BeadTask(Callable):
+	"""Callable that localises a single bead so the beads can be run in a worker pool"""
+	def __init__(self, Imp, Point, Radius, HalfWidth, Method):
+		"""Initializes the task with the bead and fitting settings"""
+		self.Imp = Imp
+		self.Point = Point
+		self.Radius = Radius
+		self.HalfWidth = HalfWidth
+		self.Method = Method
+
+	def call(self):
+		"""Method that is called by the worker pool"""
+		return localiseBead(self.Imp, self.Point, self.Radius, self.HalfWidth, self.Method)
+
+
+def fitLine(XList, YList):
+	"""Fits a straight line by least squares
+
+	Args:
+		XList ([float]): X values
+		YList ([float]): Y values
+
+	Returns:
+		(float, float): Slope and intercept, NaN if there are less than two distinct X values
+	"""
+	if len(XList) < 2:
+		return float("NaN"), float("NaN")
+	MeanX = sum(XList) / len(XList)
+	MeanY = sum(YList) / len(YList)
+	SXX = sum([(X - MeanX) * (X - MeanX) for X in XList])
+	SXY = sum([(X - MeanX) * (Y - MeanY) for X, Y in zip(XList, YList)])
+	if SXX == 0:
+		return float("NaN"), float("NaN")
+	Slope = SXY / SXX
+	return Slope, MeanY - Slope * MeanX
+
+
+def analyzeBeads(Imp, LadderList, FeducialLine, Radius, HalfWidth, Method, Workers):
+	"""Localises each bead of the ladder in its own sub-volume and fits the slope of the ladder
+
+	Args:
+		Imp (ij.ImagePlus): Z stack of the ladder
+		LadderList ([tuple]): X and Y coordinates of the centroid of each bead
+		FeducialLine (ij.gui.Line): Line from one end of the ladder to the other
+		Radius (int): Half the width of the sub-volume around each bead in pixels
+		HalfWidth (int): Number of Z planes either side of the brightest plane to fit to
+		Method (str): "Gaussian", "Parabola" or "None", see fitPeak
+		Workers (int): Number of beads to localise at once
+
+	Returns:
+		(ij.measure.ResultsTable, float): Position of each bead ordered along the ladder 
+			and the slope of the axial position against the distance along the ladder
+	"""
+	Calibration = Imp.getCalibration()
+	Pool = Executors.newFixedThreadPool(max(1, Workers))
+	try:
+		Futures = [Pool.submit(BeadTask(Imp, Point, Radius, HalfWidth, Method)) for Point in LadderList]
+		FitList = [Future.get() for Future in Futures]
+	finally:
+		Pool.shutdown()
+	# Unit vector along the ladder so each bead can be given a distance along it
+	Length = distanceBetweenPoints(FeducialLine.x1d, FeducialLine.y1d, FeducialLine.x2d, FeducialLine.y2d)
+	DX = (FeducialLine.x2d - FeducialLine.x1d) / Length
+	DY = (FeducialLine.y2d - FeducialLine.y1d) / Length
+	BeadList = []
+	for Point, (Z, Residual) in zip(LadderList, FitList):
+		Distance = ((Point[0] - FeducialLine.x1d) * DX + (Point[1] - FeducialLine.y1d) * DY) * Calibration.pixelWidth
+		BeadList.append((Distance, Point, Z, Residual))
+	BeadList.sort()
+
+	BeadResults = ResultsTable()
+	for Index, (Distance, Point, Z, Residual) in enumerate(BeadList):
+		BeadResults.incrementCounter()
+		BeadResults.addValue("X", Point[0])
+		BeadResults.addValue("Y", Point[1])
+		BeadResults.addValue("LadderDistance", Distance)
+		BeadResults.addValue("Z", Z)
+		BeadResults.addValue("FitResidual", Residual)
+		BeadResults.addValue("AxialStep", Z * Calibration.pixelDepth)
+		if Index > 0:
+			BeadResults.addValue("AxialDiff", abs(Z - BeadList[Index - 1][2]) * Calibration.pixelDepth)
+	Slope, Intercept = fitLine(
+		[Bead[0] for Bead in BeadList], 
+		[Bead[2] * Calibration.pixelDepth for Bead in BeadList]
+	)
+	return BeadResults, Slope
+
+
+def meanAndSD(Values):
+	"""Gets the mean and sample standard deviation of a list of values
+
+	Args:
+		Values ([float]): Values to summarise
+
+	Returns:
+		(float, float): Mean and standard deviation, NaN if there are not enough values
+	"""
+	if not Values:
+		return float("NaN"), float("NaN")
+	Mean = sum(Values) / len(Values)
+	if len(Values) < 2:
+		return Mean, float("NaN")
+	Variance = sum([(Value - Mean) * (Value - Mean) for Value in Values]) / (len(Values) - 1)
+	return Mean, Math.sqrt(Variance)
+
+
+class LadderTask(Callable):
+	"""Callable that runs a single ladder image so it can be run in a worker pool"""
+	def __init__(self, input_image, output_directory, peak_fit, mode):
+		"""Initializes the task with the image to run"""
+		self.input_image = input_image
+		self.output_directory = output_directory
+		self.peak_fit = peak_fit
+		self.mode = mode
+
+	def call(self):
+		"""Method that is called by the worker pool, errors are logged so the other images still run"""
+		try:
+			# The images are run in parallel so the beads of each image are run one at a time
+			return main(self.input_image, self.output_directory, self.peak_fit, self.mode)
+		except (Exception, JavaException) as e:
+			IJ.log("Error processing " + self.input_image.getName() + ": " + str(e))
+			return None
+
+
+def batch(
+		input_directory, 
+		output_directory, 
+		workers=1,
+		peak_fit="Gaussian",
+		mode="XZ Line"):
+	"""Runs every image in a directory and saves a summary table of the results
+
+	Args:
+		input_directory (java.io.File): Directory of ladder images
+		output_directory (java.io.File): Directory to save the results to
+		workers (int, optional): Number of images to run at once. Defaults to 1.
+		peak_fit (str, optional): Peak fitted along Z to each maxima, see main. Defaults to "Gaussian".
+		mode (str, optional): "XZ Line" or "Per Bead", see main. Defaults to "XZ Line".
+	"""
+	# Gets the files that can be opened by Bioformats
+	Reader = ImageReader()
+	ImageList = [
+		File for File in sorted(input_directory.listFiles(), key=lambda File: File.getName()) 
+		if File.isFile() and Reader.isThisType(File.getPath(), True)
+	]
+	Pool = Executors.newFixedThreadPool(max(1, workers))
+	try:
+		Futures = [Pool.submit(LadderTask(ImageFile, output_directory, peak_fit, mode)) for ImageFile in ImageList]
+		# Collects the results in file order so the summary is deterministic
+		Summary = ResultsTable()
+		for Index, Future in enumerate(Futures):
+			IJ.showProgress(Index, len(Futures))
+			Result = Future.get()
+			if Result is None:
+				continue
+			FileName, BeadCount, MeanAxialDiff, SDAxialDiff, Slope = Result
+			Summary.incrementCounter()
+			Summary.addValue("File", FileName)
+			Summary.addValue("Beads", BeadCount)
+			Summary.addValue("Mean_AxialDiff", MeanAxialDiff)
+			Summary.addValue("SD_AxialDiff", SDAxialDiff)
+			Summary.addValue("Slope", Slope)
+	finally:
+		Pool.shutdown()
+	IJ.showProgress(1.0)
+	Summary.saveAs(os.path.join(output_directory.getPath(), "LadderQC_Summary.csv"))
+
 
 if __name__ == "__main__":
-	main(InputImage, OutputDirectory)
\ No newline at end of file
+	if InputImage.isDirectory():
+		batch(InputImage, OutputDirectory, Workers, PeakFit, Mode)
+	else:
+		main(InputImage, OutputDirectory, PeakFit, Mode, Workers)
\ No newline at end of file
@@ -3,13 +3,14 @@
 #@ File (label="Input Roi:", style="directory") Roi_Folder
 #@ File (label="Output", style="file") Output_File
 
-import os, sys, re
+import os, sys
 
 from ij import ImagePlus
 from ij.plugin.filter import Analyzer
 from ij.measure import Measurements
 from ij.measure import ResultsTable
 from ij.plugin.frame import RoiManager
+from ImageSets import ImageIndex
 
 def getRoiMeasurements(SampleRoi, Image, Measurement_Options):
 	"""Gets the given measurements of the provided Roi for the given image
@@ -60,14 +61,16 @@ AnalyzerClass.setMeasurements(
 OutputFile = open(OutputPath, "w")
 sys.stdout = OutputFile
 
-HomeFiles = os.listdir(InputPath)
-tiff_re_Obj = re.compile(r'\.tif{1,2}$', flags=re.IGNORECASE)
-# Filters the list of files to only include tif files
-TifFiles = filter(tiff_re_Obj.search, HomeFiles)
+# Groups the tif files into sets by their name without the wavelength
+Index = ImageIndex(InputPath)
+# Gets each tif file with the name of its image set, which is also the name of its roi zip
+TifFiles = []
+for splitfilename in sorted(Index.Sets.keys()):
+	for Wavelength in sorted(Index.Sets[splitfilename].keys()):
+		TifFiles.append((Index.Sets[splitfilename][Wavelength], splitfilename))
 
-for ImageFilename in TifFiles:
-	Imp = ImagePlus(os.path.join(InputPath, ImageFilename))
-	splitfilename = "_".join(ImageFilename.split("_")[:-1])
+for ImageFilename, splitfilename in TifFiles:
+	Imp = ImagePlus(Index.path(ImageFilename))
 	RoiMan.runCommand("Open", os.path.join(RoiPath, splitfilename+".zip"))
 	RoiList = RoiMan.getRoisAsArray()
 	outputlist = []
@@ -9,24 +9,23 @@ from ij.plugin.filter import Analyzer
 from ij.measure import ResultsTable
 from ij.gui import GenericDialog, NonBlockingGenericDialog
 from ij.io import DirectoryChooser, FileSaver
+from ImageSets import ImageIndex
 import sys, os, re
 
-## This function pulls out all the TIF files and uses re to determine if its wavelength 1 (phase contrast) or any other (fluorescence) and adds it to a dictionary
+## This function goes through the image sets and uses re to determine if its wavelength 1 (phase contrast) or any other (fluorescence) and adds it to a dictionary
 ## Key is the filename without the channel info and contains a list with the phase contrast filename in the first position and a list of other wavelengths in the second position
-def getWavelengthDict(List_of_Files):
+def getWavelengthDict(Index):
+	if len(Index.Unmatched) > 0:
+		sys.exit('Unknown File Detected')
 	WavelengthDict = {}
-	for image_filename in List_of_Files:
-		if re.search('\.tif{1,2}$', image_filename, flags = re.IGNORECASE):
-				get_wavelength = image_filename.split('_')
-				common_filename = '_'.join(get_wavelength[0:-1])
-				if common_filename not in WavelengthDict:
-					WavelengthDict[common_filename] = ['', []]
-				if re.match('w1', get_wavelength[-1], \A):			 
-					WavelengthDict[common_filename][0] = image_filename
-				elif re.match('w[2-9]', get_wavelength[-1], \A):
-					WavelengthDict[common_filename][1].append(image_filename)
-				else:
-					sys.exit('Unknown File Detected')
+	for common_filename in Index.Sets:
+		WavelengthDict[common_filename] = ['', []]
+		for Wavelength in sorted(Index.Sets[common_filename].keys()):
+			image_filename = Index.Sets[common_filename][Wavelength]
+			if re.match('w1', Wavelength, flags = re.IGNORECASE):
+				WavelengthDict[common_filename][0] = image_filename
+			else:
+				WavelengthDict[common_filename][1].append(image_filename)
 	return WavelengthDict
 
 ## Gets the original settings for measurements
@@ -51,9 +50,7 @@ if save_dir == None:
 if save_dir == image_dir:
 	sys.exit('Choose Different Save Location to Original Image Location')
 
-file_list = os.listdir(image_dir)
-
-image_dict = getWavelengthDict(file_list)
+image_dict = getWavelengthDict(ImageIndex(image_dir))
 
 
 ## Allows user to input size restrictions for Particle analysis
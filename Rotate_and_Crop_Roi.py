@@ -1,11 +1,14 @@
 ## Authors: Dr James Grimshaw | Newcastle University | james.grimshaw@newcastle.ac.uk
 ## This Macro takes a polygon or freehand Roi, and rotates it untill it has the smallest bounding box
+## Needs Geometry.py from this repository in Fiji.app/jars/Lib
 ## It will then rotate the image this much and duplicate the image to show a cropped field of view
 
 from ij import IJ
 from ij.gui import Overlay
 from ij.plugin import Duplicator, RoiRotator, RoiScaler
 
+from Geometry import minAreaRectangle
+
 def Rotate_and_Crop_Roi(Image, ROI):
 	# Gets the X/Y coordinates of the ROI
 	X = ROI.getXBase()
@@ -34,27 +37,17 @@ def Rotate_and_Crop_Roi(Image, ROI):
 	# Gets rid of the overlays
 	PolyOverlay.clear()
 	CroppedOverlay.clear()
-	# Gets bounding rectangle of the drawn ROI
-	InitialBounds = InitialROI.getBounds()
-	# Adds area of bounding rectangle to list, along with the ROI and degrees rotated (0)
-	LowestArea = [(InitialBounds.height * InitialBounds.width), InitialROI, 0]
-	# Defines RoiRotator for later use
-	RR = RoiRotator()
-	# This will loop through 0-360 degrees of rotation
-	for Degree in range(0, 361):
-		# Rotates the Roi by listed No. degrees
-		RotatedROI = RR.rotate(InitialROI, Degree)
-		# Gets the bounding box of the Roi
-		BoundingBox = RotatedROI.getBounds()
-		# Gets area of the bounding box
-		BoundingArea = BoundingBox.height * BoundingBox.width
-		# If the bounding area is lower than the previous lowest bounding area then will replace Lowest area list
-		if BoundingArea < LowestArea[0]:
-			LowestArea = [BoundingArea, RotatedROI, Degree]
-	# Rotates the image by the same number of degrees as the lowest area roi rotation
-	IJ.run(Cropped, "Rotate... ", "angle="+str(LowestArea[2])+" grid=1 interpolation=Bilinear stack")
+	# Finds the angle of the smallest rectangle around the outline of the ROI
+	Polygon = InitialROI.getFloatPolygon()
+	RectangleAngle, RectangleArea = minAreaRectangle(zip(Polygon.xpoints, Polygon.ypoints))
+	# Rotating by minus the angle of the rectangle lines it up with the image
+	Degree = (-RectangleAngle) % 90
+	# Rotates the Roi once by the exact angle
+	RotatedROI = RoiRotator().rotate(InitialROI, Degree)
+	# Rotates the image by the same number of degrees as the roi
+	IJ.run(Cropped, "Rotate... ", "angle="+str(Degree)+" grid=1 interpolation=Bilinear stack")
 	# Selects the rotated Roi on the rotated image
-	Cropped.setRoi(LowestArea[1])
+	Cropped.setRoi(RotatedROI)
 	# Crops the image using the rotated Roi (Will actually use its bounding box)
 	TightCrop = Duplicator().run(Cropped)
 	return TightCrop
@@ -2,7 +2,8 @@ from ij.plugin.frame import RoiManager
 from ij import ImagePlus, IJ, ImageStack
 from ij.io import DirectoryChooser
 from ij.gui import NonBlockingGenericDialog
-import sys, os, re
+from ImageSets import ImageIndex
+import sys, os
 
 # Dialog where user chooses where their images should be kept
 ImagesChooser = DirectoryChooser('Choose where to find your images')
@@ -24,26 +25,17 @@ if Manager != None:
 else:
 	Manager = RoiManager()
 
-# Defines the pattern for searching for tif/tiff files
-Extension_Pattern = r'\.tif$|\.tiff$'
+# Groups the images into sets by their name without the wavelength
+Index = ImageIndex(ImagesDir)
+if len(Index.Unmatched) > 0:
+	sys.exit('Unknown File Detected')
 
 image_dict = {}
 
-for FileName in os.listdir(ImagesDir):
-	# Uses regular expressions to find tif/tiff extensions
-	if re.search(Extension_Pattern, FileName, flags=re.IGNORECASE):
-		# Splits the filename from extension to label the data
-		Split_Filename = re.split(Extension_Pattern, FileName, flags=re.IGNORECASE)
-		# Gets the wavelength by splitting up the filename at the _
-		get_wavelength = Split_Filename[0].split('_')
-		# Gets the common filename without the wavelength by joining everything bar the wavelength back together
-		common_filename = '_'.join(get_wavelength[0:-1])
-		if common_filename not in image_dict:
-			image_dict[common_filename]={}
-		if re.match('w[1-9]', get_wavelength[-1], flags=re.IGNORECASE): #  Figure out way to put in order using W2, 3, 4 for list.
-			image_dict[common_filename][get_wavelength[-1]] = os.path.join(ImagesDir, FileName)
-		else:
-			sys.exit('Unknown File Detected')
+for common_filename in Index.Sets:
+	image_dict[common_filename] = {}
+	for Wavelength in Index.Sets[common_filename]:
+		image_dict[common_filename][Wavelength] = Index.path(Index.Sets[common_filename][Wavelength])
 Prog = 0
 NumFiles = len(image_dict.keys())
 
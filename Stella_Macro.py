@@ -11,19 +11,91 @@
 #@ Float (label="yH2AX foci size - Rolling Ball:", style="format:#####.#####") yH2AX_Foci_RollingBall
 #@ Float (label="yH2AX foci prominence:", style="format:#####.#####") yH2AX_Foci_Prominence
 #@ File (label="Kernel File:", style="file") KernelFile
+#@ String (label="Additional Foci Channels (Name:Channel:RollingBall:Prominence[:KernelFile];...):", value="") Extra_Foci
+#@ String (label="Prominence Sweep (comma separated, blank to disable):", value="") Prominence_Sweep
+#@ Boolean (label="Label Map Foci Assignment", value=false) LabelMapMode
+#@ Boolean (label="Reuse Saved Nuclei Segmentation", value=false) ReuseNuclei
+#@ Integer (label="Worker Threads:", value=1) Workers
+#@ Integer (label="Tile Size (pixels, 0 to disable):", value=0) TileSize
+#@ Boolean (label="Long Format Output (one row per nucleus)", value=false) LongFormat
+#@ Boolean (label="Save Individual Foci (long format only)", value=false) SaveFoci
+#@ Float (label="Colocalisation Distance (microns, 0 to disable):", value=0, style="format:#####.#####") Coloc_Distance
 #@ Boolean (label="Test Mode", value=false) TestMode
 
 from ij import IJ
 from ij.gui import GenericDialog, NonBlockingGenericDialog, DialogListener, Overlay, PointRoi
+from ij.process import ShortProcessor, FloatProcessor
 from ij.plugin import ChannelSplitter
-from ij.plugin.filter import MaximumFinder, PlugInFilter, PlugInFilterRunner
+from ij.plugin.filter import MaximumFinder, ParticleAnalyzer, PlugInFilter, PlugInFilterRunner
+from ij.measure import Measurements, ResultsTable
+from ij.io import RoiDecoder, RoiEncoder
 
 from loci.plugins import BF
 from loci.plugins.in import ImporterOptions
 from loci.formats import ImageReader
 from loci.formats.services import OMEXMLServiceImpl
 
-import re
+from java.awt import Rectangle
+from java.io import BufferedOutputStream, ByteArrayOutputStream, DataOutputStream, FileInputStream, FileOutputStream
+from java.util.concurrent import Callable, Executors
+from java.util.zip import ZipEntry, ZipInputStream, ZipOutputStream
+from jarray import zeros
+
+import csv, hashlib, os, re
+from collections import deque, OrderedDict
+
+class LRUCache(object):
+	"""Bounded cache that discards the least recently used item when full"""
+	def __init__(self, maxsize):
+		"""Initializes the cache
+
+		Args:
+			maxsize (int): Maximum number of items to keep. A size of 0 disables the cache
+		"""
+		self.maxsize = maxsize
+		self.items = OrderedDict()
+
+	def get(self, key):
+		"""Gets the item for the key, returning None if it is not cached"""
+		if key not in self.items:
+			return None
+		# Moves the item to the end as it is now the most recently used
+		value = self.items.pop(key)
+		self.items[key] = value
+		return value
+
+	def put(self, key, value):
+		"""Adds an item to the cache, discarding the least recently used if full"""
+		if self.maxsize <= 0:
+			return
+		if key in self.items:
+			del self.items[key]
+		self.items[key] = value
+		while len(self.items) > self.maxsize:
+			# OrderedDict keeps insertion order so the first item is the oldest
+			self.items.popitem(last=False)
+
+class FociChannel(object):
+	"""Settings for a single foci channel"""
+	def __init__(self, Name, Index, rollingball, prominence, kernel):
+		"""Initializes the foci channel settings
+
+		Args:
+			Name (str): Name of the foci marker used in the output
+			Index (int): Channel number of the foci in the image
+			rollingball (float): Size of the rolling ball for foci background subtraction in scaled units
+			prominence (float): Minimum intensity of foci in convolved image
+			kernel (str): Pattern for convolving the image
+		"""
+		self.Name = Name
+		self.Index = Index
+		self.rollingball = rollingball
+		self.prominence = prominence
+		self.kernel = kernel
+
+	def copy(self):
+		"""Returns a copy so settings can be changed without affecting other series"""
+		return FociChannel(self.Name, self.Index, self.rollingball, self.prominence, self.kernel)
 
 class NucleiDialogListener(DialogListener):
 	"""Dialog Listner for testing nuclei settings"""
@@ -76,17 +148,11 @@ class NucleiDialogListener(DialogListener):
 		Image = AnalysisInstance.TestImage
 		# Only update the image if the rolling ball size has changed
 		if OldNucleiBall != AnalysisInstance.Nuclei_rollingball:
-			# Starting from original processor
-			Image.setProcessor(self.processor.duplicate())
-			# Getting the rois
+			# Getting the rois, these will come from the cache if this ball size has been used before
 			self.AnalysisInstance.makeNucleiBinary()
 			self.AnalysisInstance.analyzeParticles()
-			# Setting back to the original processor so can just subtract the background
-			Image.setProcessor(self.processor.duplicate())
-			# Getting the scaled rolling ball size
-			ScaledNucleiBall = int(AnalysisInstance.Nuclei_rollingball / AnalysisInstance.scale)
-			# Subtracting the background
-			IJ.run(Image, "Subtract Background...", "rolling=" + str(ScaledNucleiBall))
+			# Displays the background subtracted image
+			Image.setProcessor(AnalysisInstance.SubbedProcessor.duplicate())
 		# Otherwise just update analyze particles
 		else:
 			try:
@@ -119,12 +185,9 @@ class FociDialogListener(DialogListener):
 		# Sets the run once to false to ensure that the foci are counted at least once
 		self.RunOnce = False
 		# Sets the correct rolling ball size and noise based on the channel
-		if Channel == "RAD51":
-			self.BallSize = AnalysisInstance.RAD_foci_rollingball
-			self.Noise = AnalysisInstance.RAD_foci_prominence
-		elif Channel == "yH2AX":
-			self.BallSize = AnalysisInstance.yH2AX_foci_rollingball
-			self.Noise = AnalysisInstance.yH2AX_foci_prominence
+		Settings = AnalysisInstance.getFociChannel(Channel)
+		self.BallSize = Settings.rollingball
+		self.Noise = Settings.prominence
 	
 	def dialogItemChanged(self, gd, event):
 		"""Method that is called when the dialog is changed"""
@@ -147,14 +210,12 @@ class FociDialogListener(DialogListener):
 		self.BallSize = gd.getNextNumber()
 		self.Noise = gd.getNextNumber()
 		self.DisplayMode = gd.getNextChoice()
-		# Only update the image if the rolling ball size has changed or if it has not been run yet
-		if oldBall != self.BallSize or self.RunOnce is False:
-			self.FociRoi = AnalysisInstance.countFoci(self.Channel, "roi")
-			# Sets the run once to true so that subtraction is not done again unless settings have changed
+		# Only recalculate the foci if the settings have changed or if it has not been run yet
+		# Subtraction and convolution will come from the cache if this ball size has been used before
+		if oldBall != self.BallSize or oldNoise != self.Noise or self.RunOnce is False:
+			self.FociRoi = AnalysisInstance.countFoci(self.Channel, "roi", self.BallSize, self.Noise)
+			# Sets the run once to true so that the foci are not counted again unless settings have changed
 			self.RunOnce = True
-		# Otherwise will only recalulate the foci if the noise has changed
-		elif oldNoise != self.Noise:
-			self.FociRoi = AnalysisInstance.runMaxima(Image, self.Noise, "roi")
 		# Clearing the old overlay
 		OldOverlay = Image.getOverlay()
 		if OldOverlay:
@@ -174,48 +235,74 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 	"""Class that runs the analysis for homologous recombination"""
 	def __init__(self,
 			  	 NucleiImage,
-				 RADImage,
-				 yH2AXImage,
+				 FociImages,
+				 FociChannels,
 				 Nuclei_rollingball,
 				 size_setting,
 				 circularity_setting,
-				 RAD_foci_rollingball,
-				 RAD_foci_prominence,
-				 yH2AX_foci_rollingball,
-				 yH2AX_foci_prominence,
-				 kernel,
 				 scale,
-				 testmode=False):
+				 testmode=False,
+				 labelmap=False,
+				 prominence_sweep=None,
+				 nuclei_roiset=None,
+				 tile_size=0,
+				 tile_workers=1,
+				 save_foci=False,
+				 channel_workers=1,
+				 coloc_distance=0):
 		"""Constructor for the analysis class
 
 		Args:
 			NucleiImage (ij.ImagePlus): Single channel nuclei image
-			RADImage (ij.ImagePlus): Single channel RAD51 image
-			yH2AXImage (ij.ImagePlus): Single channel yH2AX image
+			FociImages ([ij.ImagePlus]): Single channel foci images in the same order as FociChannels
+			FociChannels ([FociChannel]): Settings for each foci channel
 			Nuclei_rollingball (float): Size of the rolling ball for nuclei background subtraction in scaled units
 			size_setting (str): Analyze particles size setting
 			circularity_setting (str): Analyze particles circularity setting
-			RAD_foci_rollingball (float): Size of the rolling ball for RAD51 foci background subtraction in scaled units
-			RAD_foci_prominence (int): Minimum intensity of RAD51 foci in convolved image
-			yH2AX_foci_rollingball (float): Size of the rolling ball for yH2AX foci background subtraction in scaled units
-			yH2AX_foci_prominence (int): Minimum intensity of yH2AX foci in convolved image
-			kernel (str): Pattern for convolving the images
 			scale (float): Physical size of a pixel in microns
 			testmode (bool, optional): Whether or not to run the macro in settings test mode. Defaults to False.
+			labelmap (bool, optional): Whether to find maxima once over the whole image and assign them to nuclei 
+				using a label image, rather than searching each nucleus separately. Defaults to False.
+			prominence_sweep ([float], optional): Prominences to count the foci of every channel with 
+				instead of the channel prominences. Defaults to None.
+			nuclei_roiset (str, optional): Path of a RoiSet zip to load the nuclei from if it exists, 
+				or to save them to if it does not. Defaults to None.
+			tile_size (int, optional): Width and height in pixels of the tiles to process the image in. 
+				0 processes the whole image at once. Defaults to 0.
+			tile_workers (int, optional): Number of tiles to process concurrently. Defaults to 1.
+			save_foci (bool, optional): Whether to keep the position and intensity of each foci. 
+				Not used with a prominence sweep. Defaults to False.
+			channel_workers (int, optional): Number of foci channels to process concurrently. Defaults to 1.
+			coloc_distance (float, optional): Distance in microns within which foci of two channels are colocalised. 
+				0 disables colocalisation. Not used with a prominence sweep. Defaults to 0.
 		"""
 		self.NucleiImage = NucleiImage
-		self.RADImage = RADImage
-		self.yH2AXImage = yH2AXImage
+		# Copies the settings as test mode may change them
+		self.FociChannels = [Channel.copy() for Channel in FociChannels]
+		# Images are looked up by the name of the foci channel
+		self.FociImages = dict(zip([Channel.Name for Channel in FociChannels], FociImages))
 		self.Nuclei_rollingball = Nuclei_rollingball
 		self.size_setting = size_setting
 		self.circularity_setting = circularity_setting
-		self.RAD_foci_rollingball = RAD_foci_rollingball
-		self.RAD_foci_prominence = RAD_foci_prominence
-		self.yH2AX_foci_rollingball = yH2AX_foci_rollingball
-		self.yH2AX_foci_prominence = yH2AX_foci_prominence
-		self.kernel = kernel
 		self.scale = scale
 		self.testmode = testmode
+		self.labelmap = labelmap
+		self.prominence_sweep = prominence_sweep
+		self.nuclei_roiset = nuclei_roiset
+		self.tile_size = tile_size
+		self.tile_workers = tile_workers
+		self.save_foci = save_foci
+		self.channel_workers = channel_workers
+		self.coloc_distance = coloc_distance
+		# Individual foci are needed for the output or to colocalise them
+		self.keep_foci = (save_foci or coloc_distance > 0) and not prominence_sweep
+		# Label image of the nuclei, built on demand from the RoiList
+		self.LabelProcessor = None
+		# Caches intermediate results so test mode previews can revisit settings instantly
+		# Keyed by (channel, rolling ball) for processors and by nuclei settings for ROI
+		# Only used in test mode as the analysis runs each setting once
+		self.ProcessorCache = LRUCache(6 if testmode else 0)
+		self.RoiCache = LRUCache(32 if testmode else 0)
 
 	def setup(self, arg, imp):
 		"""Required method for PlugInFilter"""
@@ -234,6 +321,15 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 
 	def makeNucleiBinary(self):
 		"""Preprocesses and segments the nuclei image"""
+		CacheKey = ("Nuclei", self.Nuclei_rollingball)
+		Cached = self.ProcessorCache.get(CacheKey)
+		# Uses the cached processors if this rolling ball size has already been run
+		if Cached is not None:
+			self.SubbedProcessor, BinaryProcessor = Cached
+			# Creates the image with the nuclei calibration so analyze particles uses scaled units
+			self.NucleiBinary = self.NucleiImage.createImagePlus()
+			self.NucleiBinary.setProcessor(BinaryProcessor.duplicate())
+			return
 		# Duplicates the nuclei image to keep the original intact
 		self.NucleiBinary = self.NucleiImage.duplicate()
 		# Subtracts the background from the nuclei image 
@@ -250,30 +346,123 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 		IJ.run(self.NucleiBinary, "Fill Holes", "")
 		IJ.run(self.NucleiBinary, "Median...", "radius=3")
 		IJ.run(self.NucleiBinary, "Watershed", "")
+		# Stores the processors so this rolling ball size does not need to be run again
+		self.ProcessorCache.put(CacheKey, (self.SubbedProcessor, self.NucleiBinary.getProcessor().duplicate()))
 
 	def analyzeParticles(self):
 		"""Runs the analyze particles command on the nuclei image"""
-		# Defines analyse particles settings
-		AnalyzeParticlesSettings = (
-			"size=" 
-			+ self.size_setting 
-			+ " circularity=" 
-			+ self.circularity_setting 
-			+ " clear overlay exclude"
+		CacheKey = (self.Nuclei_rollingball, self.size_setting, self.circularity_setting)
+		Cached = self.RoiCache.get(CacheKey)
+		# Uses the cached ROI if these nuclei settings have already been run
+		if Cached is not None:
+			self.RoiList = Cached
+			self.LabelProcessor = None
+			return
+		# Sizes are in calibrated units like the analyze particles command, the particle analyzer needs pixels
+		MinSize, MaxSize = parseRange(self.size_setting, float("Infinity"))
+		MinCirc, MaxCirc = parseRange(self.circularity_setting, 1.0)
+		Calibration = self.NucleiBinary.getCalibration()
+		PixelArea = Calibration.pixelWidth * Calibration.pixelHeight
+		# Uses its own results table so several images can be analysed at once
+		RTable = ResultsTable()
+		# Outlines are added to the overlay in order to not have ROIManger shown to user
+		Analyzer = ParticleAnalyzer(
+			ParticleAnalyzer.SHOW_OVERLAY_OUTLINES | ParticleAnalyzer.EXCLUDE_EDGE_PARTICLES,
+			Measurements.AREA,
+			RTable,
+			MinSize / PixelArea,
+			MaxSize / PixelArea,
+			MinCirc,
+			MaxCirc
 		)
-		# Runs the analyze particles command to get ROI. 
-		# Done by adding to the overlay in order to not have ROIManger shown to user
-		IJ.run(self.NucleiBinary, "Analyze Particles...", AnalyzeParticlesSettings)
-		# Gets the Overlayed ROIs from analyze particles
+		Analyzer.setHideOutputImage(True)
+		self.NucleiBinary.setOverlay(None)
+		Analyzer.analyze(self.NucleiBinary)
+		# Gets the Overlayed ROIs from the particle analyzer
 		Overlayed_Rois = self.NucleiBinary.getOverlay()
 		# Takes the overlay and turns it into an array of ROI
-		RoiList = Overlayed_Rois.toArray()
+		if Overlayed_Rois is not None:
+			RoiList = Overlayed_Rois.toArray()
+		else:
+			RoiList = []
 		# Removes this overlay to clean up the image
-		IJ.run(self.NucleiBinary, "Remove Overlay", "")
+		self.NucleiBinary.setOverlay(None)
 		self.RoiList = RoiList
+		self.RoiCache.put(CacheKey, RoiList)
+		# The nuclei have changed so the label image needs to be rebuilt
+		self.LabelProcessor = None
+
+	def makeLabelProcessor(self, Width, Height):
+		"""Creates a label image where each pixel is the index + 1 of the nuclei it belongs to
+
+		Args:
+			Width (int): Width of the image in pixels
+			Height (int): Height of the image in pixels
+
+		Returns:
+			ij.process.ImageProcessor: Label image with background of 0
+		"""
+		# Short processor can only hold 65535 labels so will use float if there are more
+		if len(self.RoiList) < 65535:
+			LabelProcessor = ShortProcessor(Width, Height)
+		else:
+			LabelProcessor = FloatProcessor(Width, Height)
+		# Fills each nuclei with its label
+		for Index, roi in enumerate(self.RoiList):
+			LabelProcessor.setValue(Index + 1)
+			LabelProcessor.fill(roi)
+		return LabelProcessor
+
+	def runMaximaLabelMap(self, Image, noise, mode="number"):
+		"""Runs the maxima finder once on the whole image and assigns each maxima to a nuclei
+
+		Args:
+			Image (ij.ImagePlus): Processed image to find the maxima in
+			noise (float): Prominence of the maxima
+			mode (str, optional): Whether to return the foci ROI, number of foci or list of foci. Defaults to "number".
+
+		Returns:
+			[int], ij.gui.PointRoi or [tuple]: Either the number of foci per nuclei, the foci ROI for all nuclei 
+				or the (x, y, intensity, nuclei index) of each foci
+		"""
+		# Makes sure the maxima are found over the whole image
+		Image.deleteRoi()
+		Processor = Image.getProcessor()
+		Processor.resetRoi()
+		# Only builds the label image once for each set of nuclei
+		if self.LabelProcessor is None:
+			self.LabelProcessor = self.makeLabelProcessor(Image.getWidth(), Image.getHeight())
+		# Gets all of the maxima in the image as a java.awt.Polygon
+		Polygon = MaximumFinder().getMaxima(Processor, noise, False)
+		counts = [0] * len(self.RoiList)
+		x = []
+		y = []
+		foci = []
+		# Assigns each maxima to the nuclei it falls within
+		for i in range(Polygon.npoints):
+			Label = int(self.LabelProcessor.getf(Polygon.xpoints[i], Polygon.ypoints[i]))
+			# Maxima outside of the nuclei are ignored
+			if Label == 0:
+				continue
+			counts[Label - 1] += 1
+			x.append(Polygon.xpoints[i])
+			y.append(Polygon.ypoints[i])
+			foci.append((Polygon.xpoints[i], 
+						 Polygon.ypoints[i], 
+						 Processor.getf(Polygon.xpoints[i], Polygon.ypoints[i]), 
+						 Label - 1))
+		if mode == "number":
+			return counts
+		elif mode == "roi":
+			return PointRoi(x, y)
+		elif mode == "foci":
+			return foci
 
 	def runMaxima(self, Image, noise, mode="number"):
 		"""Runs the maxima finder on the image for each nuclei"""
+		# Uses a single pass over the image if in label map mode
+		if self.labelmap:
+			return self.runMaximaLabelMap(Image, noise, mode)
 		pointlist = []
 		# Iterates through each nuclei ROI
 		for roi in self.RoiList:
@@ -292,43 +481,111 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 				x += point.xpoints
 				y += point.ypoints
 			return PointRoi(x, y)
+		# If the individual foci are needed, gets their position, intensity and nuclei
+		elif mode == "foci":
+			Processor = Image.getProcessor()
+			foci = []
+			for Index, point in enumerate(pointlist):
+				for i in range(point.npoints):
+					foci.append((point.xpoints[i], 
+								 point.ypoints[i], 
+								 Processor.getf(point.xpoints[i], point.ypoints[i]), 
+								 Index))
+			return foci
 
-	def countFoci(self, Channel, mode="number"):
-		"""Preprocesses and counts the foci in the image
+	def getFociChannel(self, Channel):
+		"""Gets the settings for a foci channel
 
 		Args:
-			Channel (str): The channel to be analyzed. Must be either "RAD51" or "yH2AX"
-			mode (str, optional): Whether to return the foci ROI or number of foci. Defaults to "number".
+			Channel (str): Name of the foci channel
 
 		Returns:
-			int or ij.gui.PointRoi: Either the number of foci per nuclei or the foci ROI for all nuclei
+			FociChannel: Settings for the channel
 		"""
-		# Sets the image and the rolling ball size and noise based on the channel
-		if Channel == "RAD51":
-			Image = self.RADImage
-			ballsize = self.RAD_foci_rollingball
-			noise = self.RAD_foci_prominence
-		elif Channel == "yH2AX":
-			Image = self.yH2AXImage
-			ballsize = self.yH2AX_foci_rollingball
-			noise = self.yH2AX_foci_prominence
+		for Settings in self.FociChannels:
+			if Settings.Name == Channel:
+				return Settings
 		# Checks if the channel is valid
-		else:
-			raise ValueError("Channel must be either RAD51 or yH2AX")
-		# Checks if the mode is valid
-		if mode != "number" and mode != "roi":
-			raise ValueError("Mode must be either number or roi")
+		raise ValueError("Channel must be one of " + ", ".join([Settings.Name for Settings in self.FociChannels]))
+
+	def preprocessFoci(self, Channel, ballsize=None):
+		"""Subtracts the background and convolves the foci image
+
+		Args:
+			Channel (str): Name of the foci channel to be analyzed
+			ballsize (float, optional): Rolling ball size to use instead of the channel setting. Defaults to None.
+
+		Returns:
+			ij.ImagePlus: The convolved image to find the foci in
+		"""
+		Settings = self.getFociChannel(Channel)
+		Image = self.FociImages[Channel]
+		# Uses the channel setting unless it has been overridden
+		if ballsize is None:
+			ballsize = Settings.rollingball
+		CacheKey = (Channel, ballsize)
+		Cached = self.ProcessorCache.get(CacheKey)
+		# Uses the cached processors if this rolling ball size has already been run
+		if Cached is not None:
+			self.SubbedProcessor, self.ConvolvedProcessor = Cached
+			ConvolvedImage = Image.createImagePlus()
+			ConvolvedImage.setProcessor(self.ConvolvedProcessor.duplicate())
+			return ConvolvedImage
+		# In test mode this may be run many times so the original image must be kept intact
+		if self.testmode:
+			Image = Image.duplicate()
 		# Subtracts the background from the image
 		# Rolling ball size is scaled to the image and then rounded to an integer
 		IJ.run(Image, "Subtract Background...", "rolling=" + str(int(ballsize/self.scale)))
 		# Saves the processor to be used later if needed for test mode
-		self.SubbedProcessor = Image.getProcessor().duplicate()
+		SubbedProcessor = Image.getProcessor().duplicate()
 		# Convolve the image with the kernel
-		IJ.run(Image, "Convolve...", "text1=[" + self.kernel +"]")
+		IJ.run(Image, "Convolve...", "text1=[" + Settings.kernel +"]")
 		# Saves the processor to be used later if needed for test mode
-		self.ConvolvedProcessor = Image.getProcessor().duplicate()
-		# Gets the maxima for each nuclei from this processed image and returns it
-		return self.runMaxima(Image, noise, mode)
+		# Only kept in test mode as channels may be processed concurrently otherwise
+		if self.testmode:
+			self.SubbedProcessor = SubbedProcessor
+			self.ConvolvedProcessor = Image.getProcessor().duplicate()
+			# Stores the processors so this rolling ball size does not need to be run again
+			self.ProcessorCache.put(CacheKey, (self.SubbedProcessor, self.ConvolvedProcessor))
+		return Image
+
+	def countFoci(self, Channel, mode="number", ballsize=None, noise=None):
+		"""Preprocesses and counts the foci in the image
+
+		Args:
+			Channel (str): Name of the foci channel to be analyzed
+			mode (str, optional): Whether to return the foci ROI, number of foci or list of foci. Defaults to "number".
+			ballsize (float, optional): Rolling ball size to use instead of the channel setting. Defaults to None.
+			noise (float, optional): Prominence to use instead of the channel setting. Defaults to None.
+
+		Returns:
+			[int], ij.gui.PointRoi or [tuple]: Either the number of foci per nuclei, the foci ROI for all nuclei 
+				or the (x, y, intensity, nuclei index) of each foci
+		"""
+		# Checks if the mode is valid
+		if mode not in ("number", "roi", "foci"):
+			raise ValueError("Mode must be either number, roi or foci")
+		# Uses the channel prominence unless it has been overridden
+		if noise is None:
+			noise = self.getFociChannel(Channel).prominence
+		# Gets the maxima for each nuclei from the processed image and returns it
+		return self.runMaxima(self.preprocessFoci(Channel, ballsize), noise, mode)
+
+	def sweepFoci(self, Channel, ProminenceList):
+		"""Counts the foci in the image for several prominences
+
+		The background subtraction and convolution are only done once for the channel
+
+		Args:
+			Channel (str): Name of the foci channel to be analyzed
+			ProminenceList ([float]): Prominences to count the foci with
+
+		Returns:
+			[[int]]: Number of foci per nuclei for each prominence, in the same order as ProminenceList
+		"""
+		Image = self.preprocessFoci(Channel)
+		return [self.runMaxima(Image, Prominence, "number") for Prominence in ProminenceList]
 	
 	def testNuclei(self):
 		"""Allows the user to interactively test the nuclei settings"""
@@ -371,18 +628,14 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 	def testFoci(self, Channel):
 		"""Allows the user to interactively test the foci settings"""
 		# Sets the image, rolling ball size and noise based on the channel
-		if Channel == "RAD51":
-			self.TestImage = self.RADImage.duplicate()
-			ballsize = self.RAD_foci_rollingball
-			noise = self.RAD_foci_prominence
-		elif Channel == "yH2AX":
-			self.TestImage = self.yH2AXImage.duplicate()
-			ballsize = self.yH2AX_foci_rollingball
-			noise = self.yH2AX_foci_prominence
+		Settings = self.getFociChannel(Channel)
+		self.TestImage = self.FociImages[Channel].duplicate()
+		ballsize = Settings.rollingball
+		noise = Settings.prominence
 		# Shows the image to the user
 		self.TestImage.show()
 		# Creates a dialog for the user to interact with-----------------------------v
-		FociDialog = NonBlockingGenericDialog("Foci Settings")
+		FociDialog = NonBlockingGenericDialog(Channel + " Foci Settings")
 		FociDialog.addNumericField("Foci Rolling Ball Size", ballsize)
 		FociDialog.addNumericField("Foci Prominence", noise)
 		# This is for setting which image to look at
@@ -403,13 +656,9 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 		if FociDialog.wasCanceled():
 			return False
 		# If the dialog is not canceled, updates the foci settings 
-		# depending on the channel and returns True
-		if Channel == "RAD51":
-			self.RAD_foci_rollingball = FociDialog.getNextNumber()
-			self.RAD_foci_prominence = FociDialog.getNextNumber()
-		elif Channel == "yH2AX":
-			self.yH2AX_foci_rollingball = FociDialog.getNextNumber()
-			self.yH2AX_foci_prominence = FociDialog.getNextNumber()
+		# for the channel and returns True
+		Settings.rollingball = FociDialog.getNextNumber()
+		Settings.prominence = FociDialog.getNextNumber()
 		return True
 
 	def test(self):
@@ -419,28 +668,430 @@ class HomologousRecombinationAnalysis(PlugInFilter):
 		# canceled the dialog and the method will end
 		if not self.testNuclei():
 			return
-		if not self.testFoci("RAD51"):
-			return
-		if not self.testFoci("yH2AX"):
-			return
+		for Settings in self.FociChannels:
+			if not self.testFoci(Settings.Name):
+				return
 		# Prints the settings to the log
 		IJ.log("Nuclei Rolling Ball Size: " + str(self.Nuclei_rollingball))
 		IJ.log("Nuclei Size Setting: " + self.size_setting)
 		IJ.log("Nuclei Circularity Setting: " + self.circularity_setting)
-		IJ.log("RAD51 Rolling Ball Size: " + str(self.RAD_foci_rollingball))
-		IJ.log("RAD51 Prominence: " + str(self.RAD_foci_prominence))
-		IJ.log("yH2AX Rolling Ball Size: " + str(self.yH2AX_foci_rollingball))
-		IJ.log("yH2AX Prominence: " + str(self.yH2AX_foci_prominence))
+		for Settings in self.FociChannels:
+			IJ.log(Settings.Name + " Rolling Ball Size: " + str(Settings.rollingball))
+			IJ.log(Settings.Name + " Prominence: " + str(Settings.prominence))
 
 	def analyze(self):
 		"""Method that runs the analysis"""
-		# Preprocesses and segments the nuclei image
-		self.makeNucleiBinary()
-		# Runs analyze particles on the nuclei image to get nuclei roi
-		self.analyzeParticles()
-		# Counts the foci for each nuclei for the RAD51 and yH2AX channels
-		self.RAD51_PointList = self.countFoci("RAD51")
-		self.yH2AX_PointList = self.countFoci("yH2AX")
+		# Large images are split into tiles to limit the memory used by each step
+		if self.tile_size > 0:
+			self.analyzeTiled()
+			return
+		# Loads the nuclei from a previous run with the same settings if there is one
+		if self.nuclei_roiset and os.path.exists(self.nuclei_roiset):
+			self.RoiList = loadRoiSet(self.nuclei_roiset)
+		else:
+			# Preprocesses and segments the nuclei image
+			self.makeNucleiBinary()
+			# Runs analyze particles on the nuclei image to get nuclei roi
+			self.analyzeParticles()
+			# Saves the nuclei so they can be reused by later runs
+			if self.nuclei_roiset:
+				saveRoiSet(self.RoiList, self.nuclei_roiset)
+		self.countAllFoci()
+		self.colocaliseFoci()
+
+	def countChannelFoci(self, Channel):
+		"""Counts the foci in a single channel for each nuclei
+
+		Args:
+			Channel (str): Name of the foci channel to be analyzed
+
+		Returns:
+			([int], [[int]], [tuple]): Number of foci per nuclei, number of foci per nuclei for each prominence 
+				in the sweep and the individual foci. Those that were not run are None
+		"""
+		# Counts the foci for each prominence in the sweep if one has been given
+		if self.prominence_sweep:
+			return None, self.sweepFoci(Channel, self.prominence_sweep), None
+		# Keeps the individual foci if they are needed for the output or colocalisation
+		if self.keep_foci:
+			FociList = self.countFoci(Channel, "foci")
+			return countPerNuclei(FociList, len(self.RoiList)), None, FociList
+		# Counts the foci for each nuclei
+		return self.countFoci(Channel), None, None
+
+	def countAllFoci(self):
+		"""Counts the foci in every foci channel for each nuclei against the same nuclei"""
+		Names = [Settings.Name for Settings in self.FociChannels]
+		# The label image is shared by the channels so is made before they are run
+		if self.labelmap and self.LabelProcessor is None:
+			self.LabelProcessor = self.makeLabelProcessor(self.NucleiImage.getWidth(), self.NucleiImage.getHeight())
+		if self.channel_workers > 1 and len(Names) > 1:
+			Pool = Executors.newFixedThreadPool(min(self.channel_workers, len(Names)))
+			try:
+				Futures = [Pool.submit(ChannelTask(self, Name)) for Name in Names]
+				Results = [Future.get() for Future in Futures]
+			finally:
+				Pool.shutdown()
+		else:
+			Results = [self.countChannelFoci(Name) for Name in Names]
+		# Results are kept by channel name
+		self.PointLists = {}
+		self.Sweeps = {}
+		self.FociLists = {}
+		for Name, (PointList, Sweep, FociList) in zip(Names, Results):
+			self.PointLists[Name] = PointList
+			self.Sweeps[Name] = Sweep
+			self.FociLists[Name] = FociList
+
+	def colocaliseFoci(self):
+		"""Counts the foci of each channel that are colocalised with foci of every other channel
+
+		For each pair of channels, a foci is colocalised if a foci of the other channel in the same nuclei 
+		is within the colocalisation distance. Each channel is indexed once in a grid so only foci in 
+		neighbouring grid cells are compared
+		"""
+		self.Colocalisation = OrderedDict()
+		if self.coloc_distance <= 0 or self.prominence_sweep:
+			return
+		# Colocalisation distance in pixels
+		Distance = self.coloc_distance / self.scale
+		Names = [Settings.Name for Settings in self.FociChannels]
+		Grids = dict([(Name, FociGrid(self.FociLists[Name], Distance)) for Name in Names])
+		for Name in Names:
+			for Other in Names:
+				if Other == Name:
+					continue
+				counts = [0] * len(self.RoiList)
+				for x, y, Intensity, Nuclei in self.FociLists[Name]:
+					if Grids[Other].hasNeighbour(x, y, Nuclei):
+						counts[Nuclei] += 1
+				self.Colocalisation[(Name, Other)] = counts
+
+	def getTileHalo(self):
+		"""Gets the overlap needed around each tile so results match the whole image
+
+		Returns:
+			int: Size of the overlap in pixels
+		"""
+		# Rolling ball sizes in pixels
+		NucleiBall = int(self.Nuclei_rollingball / self.scale)
+		FociBall = int(max([Settings.rollingball for Settings in self.FociChannels]) / self.scale)
+		# Half the width of the largest convolution kernel
+		KernelRadius = 0
+		for Settings in self.FociChannels:
+			KernelRows = [Row.split() for Row in Settings.kernel.strip().splitlines() if Row.strip()]
+			KernelRadius = max(KernelRadius, max(len(KernelRows), max([len(Row) for Row in KernelRows])) // 2)
+		# The nuclei radius is added so nuclei owned by the tile are not cut by its edge
+		return NucleiBall + max(NucleiBall, FociBall) + KernelRadius
+
+	def getTiles(self):
+		"""Splits the image into tiles with an overlapping halo
+
+		Returns:
+			[(java.awt.Rectangle, java.awt.Rectangle)]: The area owned by each tile and the area including the halo
+		"""
+		Width = self.NucleiImage.getWidth()
+		Height = self.NucleiImage.getHeight()
+		Halo = self.getTileHalo()
+		Tiles = []
+		for y in range(0, Height, self.tile_size):
+			for x in range(0, Width, self.tile_size):
+				Core = Rectangle(x, y, min(self.tile_size, Width - x), min(self.tile_size, Height - y))
+				# Expands the tile by the halo without going outside of the image
+				Outer = Rectangle(Core.x - Halo, Core.y - Halo, Core.width + 2 * Halo, Core.height + 2 * Halo)
+				Tiles.append((Core, Outer.intersection(Rectangle(0, 0, Width, Height))))
+		return Tiles
+
+	def analyzeTile(self, Core, Outer, TileRois=None):
+		"""Runs the analysis on a single tile of the image
+
+		Args:
+			Core (java.awt.Rectangle): Area of the image owned by the tile
+			Outer (java.awt.Rectangle): Area of the tile including the halo
+			TileRois ([ij.gui.Roi], optional): Nuclei owned by the tile in image coordinates. 
+				Segments the nuclei if None. Defaults to None.
+
+		Returns:
+			HomologousRecombinationAnalysis: The analysis of the tile with the nuclei in image coordinates
+		"""
+		# Analyses the tile with the same settings as the whole image
+		TileAnalysis = HomologousRecombinationAnalysis(cropImage(self.NucleiImage, Outer),
+													   [cropImage(self.FociImages[Settings.Name], Outer) 
+														for Settings in self.FociChannels],
+													   self.FociChannels,
+													   self.Nuclei_rollingball,
+													   self.size_setting,
+													   self.circularity_setting,
+													   self.scale,
+													   labelmap=self.labelmap,
+													   prominence_sweep=self.prominence_sweep,
+													   save_foci=self.save_foci,
+													   coloc_distance=self.coloc_distance)
+		if TileRois is None:
+			TileAnalysis.makeNucleiBinary()
+			TileAnalysis.analyzeParticles()
+			OwnedRois = []
+			# Only keeps the nuclei whose centroid is in the area owned by the tile
+			# So nuclei in the halo are counted by the neighbouring tile
+			for roi in TileAnalysis.RoiList:
+				Centroid = roi.getContourCentroid()
+				if Core.contains(int(Centroid[0] + Outer.x), int(Centroid[1] + Outer.y)):
+					OwnedRois.append(roi)
+		else:
+			# Moves the given nuclei into the coordinates of the tile
+			OwnedRois = [shiftRoi(roi, -Outer.x, -Outer.y) for roi in TileRois]
+		TileAnalysis.RoiList = OwnedRois
+		TileAnalysis.LabelProcessor = None
+		TileAnalysis.countAllFoci()
+		# Moves the nuclei back into the coordinates of the whole image
+		TileAnalysis.RoiList = [shiftRoi(roi, Outer.x, Outer.y) for roi in OwnedRois]
+		return TileAnalysis
+
+	def analyzeTiled(self):
+		"""Runs the analysis on overlapping tiles and combines the results"""
+		Tiles = self.getTiles()
+		# Assigns saved nuclei to the tile that owns their centroid
+		TileRoiList = [None] * len(Tiles)
+		LoadNuclei = self.nuclei_roiset and os.path.exists(self.nuclei_roiset)
+		if LoadNuclei:
+			TileRoiList = [[] for Tile in Tiles]
+			for roi in loadRoiSet(self.nuclei_roiset):
+				Centroid = roi.getContourCentroid()
+				for Index, (Core, Outer) in enumerate(Tiles):
+					if Core.contains(int(Centroid[0]), int(Centroid[1])):
+						TileRoiList[Index].append(roi)
+						break
+		Pool = Executors.newFixedThreadPool(max(1, self.tile_workers))
+		try:
+			Futures = [Pool.submit(TileTask(self, Core, Outer, TileRoiList[Index])) 
+					   for Index, (Core, Outer) in enumerate(Tiles)]
+			# Combines the tiles in order so the output is deterministic
+			self.RoiList = []
+			self.PointLists = {}
+			self.Sweeps = {}
+			self.FociLists = {}
+			for Settings in self.FociChannels:
+				if self.prominence_sweep:
+					self.PointLists[Settings.Name] = None
+					self.Sweeps[Settings.Name] = [[] for Prominence in self.prominence_sweep]
+				else:
+					self.PointLists[Settings.Name] = []
+					self.Sweeps[Settings.Name] = None
+				self.FociLists[Settings.Name] = [] if self.keep_foci else None
+			for TileIndex, Future in enumerate(Futures):
+				TileAnalysis = Future.get()
+				# Nuclei of this tile are numbered after those of the previous tiles
+				NucleiOffset = len(self.RoiList)
+				self.RoiList += TileAnalysis.RoiList
+				Outer = Tiles[TileIndex][1]
+				for Settings in self.FociChannels:
+					Name = Settings.Name
+					if self.prominence_sweep:
+						for Index in range(len(self.prominence_sweep)):
+							self.Sweeps[Name][Index] += TileAnalysis.Sweeps[Name][Index]
+						continue
+					self.PointLists[Name] += TileAnalysis.PointLists[Name]
+					# Moves the foci into the coordinates of the whole image
+					if self.FociLists[Name] is not None:
+						self.FociLists[Name] += [(x + Outer.x, y + Outer.y, Intensity, Nuclei + NucleiOffset) 
+												 for x, y, Intensity, Nuclei in TileAnalysis.FociLists[Name]]
+		finally:
+			Pool.shutdown()
+		self.LabelProcessor = None
+		# Colocalises the combined foci so foci near the edges of the tiles are compared
+		self.colocaliseFoci()
+		# Saves the nuclei so they can be reused by later runs
+		if self.nuclei_roiset and not LoadNuclei:
+			saveRoiSet(self.RoiList, self.nuclei_roiset)
+
+class TileTask(Callable):
+	"""Callable that analyses a single tile so it can be run in a worker pool"""
+	def __init__(self, AnalysisInstance, Core, Outer, TileRois):
+		"""Initializes the task with the tile areas"""
+		self.AnalysisInstance = AnalysisInstance
+		self.Core = Core
+		self.Outer = Outer
+		self.TileRois = TileRois
+
+	def call(self):
+		"""Method that is called by the worker pool"""
+		return self.AnalysisInstance.analyzeTile(self.Core, self.Outer, self.TileRois)
+
+class ChannelTask(Callable):
+	"""Callable that counts the foci of a single channel so it can be run in a worker pool"""
+	def __init__(self, AnalysisInstance, Channel):
+		"""Initializes the task with the channel name"""
+		self.AnalysisInstance = AnalysisInstance
+		self.Channel = Channel
+
+	def call(self):
+		"""Method that is called by the worker pool"""
+		return self.AnalysisInstance.countChannelFoci(self.Channel)
+
+class FociGrid(object):
+	"""Spatial index that buckets foci into a grid of square cells"""
+	def __init__(self, FociList, Distance):
+		"""Builds the grid
+
+		Args:
+			FociList ([tuple]): The (x, y, intensity, nuclei index) of each foci
+			Distance (float): Search distance in pixels, used as the size of the grid cells
+		"""
+		self.Distance = Distance
+		# Cells are at least a pixel so very small distances do not make a sparse grid
+		self.CellSize = max(Distance, 1.0)
+		self.Cells = {}
+		for x, y, Intensity, Nuclei in FociList:
+			Key = (int(x // self.CellSize), int(y // self.CellSize))
+			self.Cells.setdefault(Key, []).append((x, y, Nuclei))
+
+	def hasNeighbour(self, x, y, Nuclei):
+		"""Checks if there is a foci in the same nuclei within the search distance
+
+		Args:
+			x (float): X position in pixels
+			y (float): Y position in pixels
+			Nuclei (int): Index of the nuclei
+
+		Returns:
+			bool: True if a foci is within the search distance
+		"""
+		CellX = int(x // self.CellSize)
+		CellY = int(y // self.CellSize)
+		Limit = self.Distance * self.Distance
+		# The search distance is no larger than a cell so only the surrounding cells are checked
+		for dx in (-1, 0, 1):
+			for dy in (-1, 0, 1):
+				for fx, fy, FociNuclei in self.Cells.get((CellX + dx, CellY + dy), ()):
+					if FociNuclei == Nuclei and (fx - x) ** 2 + (fy - y) ** 2 <= Limit:
+						return True
+		return False
+
+def parseRange(Setting, Default_Max):
+	"""Splits an analyze particles range setting such as 50-Infinity into its min and max
+
+	Args:
+		Setting (str): Minimum and maximum separated by a -, or only the minimum
+		Default_Max (float): Maximum used if only the minimum is given
+
+	Returns:
+		(float, float): Minimum and maximum of the range
+	"""
+	Parts = Setting.strip().split('-')
+	Minimum = float(Parts[0])
+	if len(Parts) > 1 and Parts[1].strip() != '':
+		return Minimum, float(Parts[1])
+	return Minimum, Default_Max
+
+def countPerNuclei(FociList, NumNuclei):
+	"""Counts the number of foci in each nuclei
+
+	Args:
+		FociList ([tuple]): The (x, y, intensity, nuclei index) of each foci
+		NumNuclei (int): Number of nuclei
+
+	Returns:
+		[int]: Number of foci per nuclei
+	"""
+	counts = [0] * NumNuclei
+	for Foci in FociList:
+		counts[Foci[3]] += 1
+	return counts
+
+def cropImage(Image, Bounds):
+	"""Crops an image without using its ROI so it can be done from several threads
+
+	Args:
+		Image (ij.ImagePlus): Image to be cropped
+		Bounds (java.awt.Rectangle): Area to crop
+
+	Returns:
+		ij.ImagePlus: Cropped image with the same calibration
+	"""
+	Processor = Image.getProcessor()
+	Cropped = Processor.createProcessor(Bounds.width, Bounds.height)
+	# Inserting at a negative offset copies just the area within the bounds
+	Cropped.insert(Processor, -Bounds.x, -Bounds.y)
+	CroppedImage = Image.createImagePlus()
+	CroppedImage.setProcessor(Image.getTitle(), Cropped)
+	return CroppedImage
+
+def shiftRoi(roi, dx, dy):
+	"""Returns a copy of the ROI moved by the given offset"""
+	Shifted = roi.clone()
+	Shifted.setLocation(roi.getXBase() + dx, roi.getYBase() + dy)
+	return Shifted
+
+def saveRoiSet(RoiList, path):
+	"""Saves a list of ROI as a RoiSet zip without using the ROI Manager
+
+	Args:
+		RoiList ([ij.gui.Roi]): ROI to be saved
+		path (str): Path of the zip file
+	"""
+	# Writes to a temporary file first so a partially written zip is never loaded
+	TempPath = path + ".tmp"
+	ZipStream = ZipOutputStream(BufferedOutputStream(FileOutputStream(TempPath)))
+	OutStream = DataOutputStream(BufferedOutputStream(ZipStream))
+	Encoder = RoiEncoder(OutStream)
+	try:
+		for Index, roi in enumerate(RoiList):
+			# Names are zero padded so they are loaded back in the same order
+			ZipStream.putNextEntry(ZipEntry("%06d.roi" % (Index + 1)))
+			Encoder.write(roi)
+			OutStream.flush()
+	finally:
+		OutStream.close()
+	if os.path.exists(path):
+		os.remove(path)
+	os.rename(TempPath, path)
+
+def loadRoiSet(path):
+	"""Loads a RoiSet zip without using the ROI Manager
+
+	Args:
+		path (str): Path of the zip file
+
+	Returns:
+		[ij.gui.Roi]: ROI in the order they were saved
+	"""
+	RoiList = []
+	ZipStream = ZipInputStream(FileInputStream(path))
+	Buffer = zeros(8192, "b")
+	try:
+		Entry = ZipStream.getNextEntry()
+		while Entry is not None:
+			if Entry.getName().endswith(".roi"):
+				# Reads the whole entry into memory so it can be decoded
+				Bytes = ByteArrayOutputStream()
+				Length = ZipStream.read(Buffer)
+				while Length > 0:
+					Bytes.write(Buffer, 0, Length)
+					Length = ZipStream.read(Buffer)
+				RoiList.append(RoiDecoder.openFromByteArray(Bytes.toByteArray()))
+			Entry = ZipStream.getNextEntry()
+	finally:
+		ZipStream.close()
+	return RoiList
+
+def nucleiRoiSetPath(imagepath, outputpath, series, NucleiSettings):
+	"""Gets the path of the saved nuclei RoiSet for a series and its nuclei settings
+
+	Args:
+		imagepath (str): Path to the image
+		outputpath (str): Path to the output csv file, the RoiSet is saved next to this
+		series (int): Index of the series
+		NucleiSettings (list): Settings that affect the nuclei segmentation
+
+	Returns:
+		str: Path of the RoiSet zip
+	"""
+	# Includes the modified time so the segmentation is redone if the image changes
+	Key = [os.path.abspath(imagepath), os.path.getmtime(imagepath), series] + list(NucleiSettings)
+	Hash = hashlib.md5("|".join([str(x) for x in Key])).hexdigest()[:12]
+	ImageName = os.path.splitext(os.path.basename(imagepath))[0]
+	FileName = ImageName + "_Series" + str(series) + "_" + Hash + "_NucleiRoiSet.zip"
+	return os.path.join(os.path.dirname(os.path.abspath(outputpath)), FileName)
 
 def saveResults(OutputDict, csvfile):
 	"""Saves the results to a csv file"""
@@ -471,6 +1122,201 @@ def saveResults(OutputDict, csvfile):
 		# Increments the index
 		index += 1
 
+def openSeries(imagepath, series):
+	"""Imports a single series from the image file
+
+	Args:
+		imagepath (str): Path to the image
+		series (int): Index of the series to import
+
+	Returns:
+		ij.ImagePlus: Multichannel image of the series
+	"""
+	Options = ImporterOptions()
+	Options.setId(imagepath)
+	# Only switches on the requested series so the others are not held in memory
+	Options.clearSeries()
+	Options.setSeriesOn(series, True)
+	return BF.openImagePlus(Options)[0]
+
+def iterateSeries(imagepath, SeriesList):
+	"""Lazily imports the selected series one at a time
+
+	Args:
+		imagepath (str): Path to the image
+		SeriesList ([int]): Indexes of the series to import
+
+	Yields:
+		(int, ij.ImagePlus): Index of the series and its image
+	"""
+	for series in SeriesList:
+		yield series, openSeries(imagepath, series)
+
+def analyzeSeries(Image, nuclei_channel, FociChannels, AnalysisSettings):
+	"""Splits a series into channels and runs the analysis on it
+
+	Args:
+		Image (ij.ImagePlus): Multichannel image of a single series
+		nuclei_channel (int): Channel number for nuclei
+		FociChannels ([FociChannel]): Settings for each foci channel
+		AnalysisSettings (dict): Keyword arguments for HomologousRecombinationAnalysis other than the images
+
+	Returns:
+		HomologousRecombinationAnalysis: The analysis instance after it has been run
+	"""
+	# Splits the image into channels
+	Channels = ChannelSplitter.split(Image)
+	# Gets the image for each foci channel
+	# Foci are processed in place so a channel used more than once is duplicated
+	FociImages = []
+	UsedIndexes = set()
+	for Settings in FociChannels:
+		if Settings.Index in UsedIndexes:
+			FociImages.append(Channels[Settings.Index-1].duplicate())
+		else:
+			FociImages.append(Channels[Settings.Index-1])
+			UsedIndexes.add(Settings.Index)
+	# Initialises the analysis class
+	Analysis = HomologousRecombinationAnalysis(Channels[nuclei_channel-1], 
+											   FociImages, 
+											   FociChannels, 
+											   **AnalysisSettings)
+	# Runs the analysis
+	Analysis.runMacro()
+	# Closes the channels and the original image
+	for Channel in Channels + FociImages:
+		Channel.close()
+	Image.close()
+	return Analysis
+
+def recordResults(OutputDict, Title, Analysis):
+	"""Adds the foci counts of an analysed series to the output dictionary"""
+	try:
+		for Settings in Analysis.FociChannels:
+			Name = Settings.Name
+			# Adds a column for each prominence if a sweep has been run
+			if Analysis.prominence_sweep:
+				for Index, Prominence in enumerate(Analysis.prominence_sweep):
+					OutputDict[Title + " " + Name + " Prominence=" + str(Prominence)] = Analysis.Sweeps[Name][Index]
+			else:
+				OutputDict[Title + " " + Name] = Analysis.PointLists[Name]
+		# Adds a column for each pair of colocalised channels
+		for (Name, Other), counts in Analysis.Colocalisation.items():
+			OutputDict[Title + " " + Name + " with " + Other] = counts
+	# Except will catch if the analysis has not been run
+	except AttributeError:
+		pass
+
+class ResultsWriter(object):
+	"""Writes long format results, appending the rows for each series as it is analysed"""
+	def __init__(self, outputpath, LineList, ChannelNames, ProminenceList=None, save_foci=False, ColocPairs=None):
+		"""Opens the output files and writes the headers
+
+		Args:
+			outputpath (str): Path to the nuclei csv file, foci are saved next to this
+			LineList ([str]): Settings to write as the first line
+			ChannelNames ([str]): Names of the foci channels, adds a count column for each
+			ProminenceList ([float], optional): Prominences of a sweep, adds a count column for each. Defaults to None.
+			save_foci (bool, optional): Whether to also write a row for each foci. Defaults to False.
+			ColocPairs ([(str, str)], optional): Pairs of channels, adds a colocalised count column for each. 
+				Defaults to None.
+		"""
+		self.ChannelNames = ChannelNames
+		self.ColocPairs = ColocPairs or []
+		self.ProminenceList = ProminenceList
+		# Foci rows are not available for a prominence sweep
+		self.save_foci = save_foci and not ProminenceList
+		self.NucleiFile = open(outputpath, "wb")
+		self.NucleiWriter = csv.writer(self.NucleiFile)
+		self.NucleiWriter.writerow(LineList)
+		Header = ["Series", "Nucleus", "X", "Y", "Area"]
+		if ProminenceList:
+			for Prominence in ProminenceList:
+				Header += [Name + " Prominence=" + str(Prominence) for Name in ChannelNames]
+		else:
+			Header += ChannelNames
+		Header += [Name + " with " + Other for Name, Other in self.ColocPairs]
+		self.NucleiWriter.writerow(Header)
+		if self.save_foci:
+			self.FociFile = open(re.sub(r"(?i)\.csv$", "", outputpath) + "_Foci.csv", "wb")
+			self.FociWriter = csv.writer(self.FociFile)
+			self.FociWriter.writerow(LineList)
+			self.FociWriter.writerow(["Series", "Channel", "X", "Y", "Intensity", "Nucleus"])
+
+	def writeSeries(self, Title, Analysis):
+		"""Writes the rows for an analysed series and flushes them to disk"""
+		# Skips series that have not been analysed
+		if not hasattr(Analysis, "RoiList"):
+			return
+		scale = Analysis.scale
+		for Index, roi in enumerate(Analysis.RoiList):
+			# Centroid and area are in scaled units
+			Centroid = roi.getContourCentroid()
+			Area = roi.getStatistics().pixelCount * scale * scale
+			Row = [Title, Index + 1, Centroid[0] * scale, Centroid[1] * scale, Area]
+			if self.ProminenceList:
+				for Sweep in range(len(self.ProminenceList)):
+					Row += [Analysis.Sweeps[Name][Sweep][Index] for Name in self.ChannelNames]
+			else:
+				Row += [Analysis.PointLists[Name][Index] for Name in self.ChannelNames]
+			Row += [Analysis.Colocalisation[Pair][Index] for Pair in self.ColocPairs]
+			self.NucleiWriter.writerow(Row)
+		self.NucleiFile.flush()
+		if self.save_foci:
+			for Channel in self.ChannelNames:
+				for x, y, Intensity, Nuclei in Analysis.FociLists[Channel]:
+					self.FociWriter.writerow([Title, Channel, x * scale, y * scale, Intensity, Nuclei + 1])
+			self.FociFile.flush()
+
+	def close(self):
+		"""Closes the output files"""
+		self.NucleiFile.close()
+		if self.save_foci:
+			self.FociFile.close()
+
+class SeriesTask(Callable):
+	"""Callable that analyses a single series so it can be run in a worker pool"""
+	def __init__(self, imagepath, series, nuclei_channel, FociChannels, AnalysisSettings):
+		"""Initializes the task with the series and its settings"""
+		self.imagepath = imagepath
+		self.series = series
+		self.nuclei_channel = nuclei_channel
+		self.FociChannels = FociChannels
+		self.AnalysisSettings = AnalysisSettings
+
+	def call(self):
+		"""Method that is called by the worker pool, imports and analyses the series"""
+		Image = openSeries(self.imagepath, self.series)
+		Title = Image.getTitle()
+		return Title, analyzeSeries(Image, self.nuclei_channel, self.FociChannels, self.AnalysisSettings)
+
+def parseFociChannels(extra_foci, kernel):
+	"""Parses the additional foci channel settings
+
+	Args:
+		extra_foci (str): Semicolon separated Name:Channel:RollingBall:Prominence[:KernelFile] settings
+		kernel (str): Kernel to use when a kernel file is not given
+
+	Returns:
+		[FociChannel]: Settings for each additional foci channel
+	"""
+	FociChannels = []
+	for Spec in extra_foci.split(";"):
+		if not Spec.strip():
+			continue
+		# Splits at most 4 times so windows kernel paths with a drive letter are kept whole
+		Parts = [Part.strip() for Part in Spec.split(":", 4)]
+		# Matches a name, integer channel, and numeric rolling ball and prominence
+		if (len(Parts) < 4 
+				or not Parts[0] 
+				or not re.match(r"^\d+$", Parts[1]) 
+				or not re.match(r"^\d+(\.\d+)?$", Parts[2]) 
+				or not re.match(r"^\d+(\.\d+)?$", Parts[3])):
+			raise ValueError("Foci channel must be Name:Channel:RollingBall:Prominence[:KernelFile], got " + Spec)
+		ChannelKernel = open(Parts[4]).read() if len(Parts) > 4 and Parts[4] else kernel
+		FociChannels.append(FociChannel(Parts[0], int(Parts[1]), float(Parts[2]), float(Parts[3]), ChannelKernel))
+	return FociChannels
+
 def main(imagepath,
 		 outputpath,
 		 Nuclei_rollingball,
@@ -484,7 +1330,16 @@ def main(imagepath,
 		 yH2AX_foci_rollingball,
 		 yH2AX_foci_prominence,
 		 kernel_file,
-		 testmode):
+		 testmode,
+		 labelmap=False,
+		 workers=1,
+		 prominence_sweep="",
+		 reuse_nuclei=False,
+		 tile_size=0,
+		 long_format=False,
+		 save_foci=False,
+		 extra_foci="",
+		 coloc_distance=0):
 	"""Main function that runs the analysis/testing
 
 	Args:
@@ -502,6 +1357,21 @@ def main(imagepath,
 		yH2AX_foci_prominence (float): Minimum intensity of yH2AX foci in convolved image
 		kernel_file (str): Path to the kernel file for convolving the images
 		testmode (bool): Whether or not to run the macro in settings test mode
+		labelmap (bool, optional): Whether to assign foci to nuclei using a label image. Defaults to False.
+		workers (int, optional): Number of series to analyse concurrently. Defaults to 1.
+		prominence_sweep (str, optional): Comma separated prominences to count the foci of every channel with. 
+			Blank to use the channel prominences. Defaults to "".
+		reuse_nuclei (bool, optional): Whether to save the nuclei segmentation next to the output 
+			and reuse it in later runs with the same nuclei settings. Defaults to False.
+		tile_size (int, optional): Size in pixels of the tiles to process each series in, 0 to disable. 
+			The workers are then used for the tiles rather than the series. Defaults to 0.
+		long_format (bool, optional): Whether to write one row per nuclei as each series finishes, 
+			rather than one column per series at the end. Defaults to False.
+		save_foci (bool, optional): Whether to also write one row per foci in long format. Defaults to False.
+		extra_foci (str, optional): Additional foci channels as semicolon separated 
+			Name:Channel:RollingBall:Prominence[:KernelFile] settings. Defaults to "".
+		coloc_distance (float, optional): Distance in microns within which foci of two channels 
+			are counted as colocalised. 0 disables colocalisation. Defaults to 0.
 	"""
 	
 	# Initialises the metadata reader
@@ -509,9 +1379,6 @@ def main(imagepath,
 	Metadata = OMEXMLServiceImpl().createOMEXMLMetadata()
 	MetaReader.setMetadataStore(Metadata)
 	MetaReader.setId(imagepath)
-	# Initialises the importer options and adds image path
-	Options = ImporterOptions()
-	Options.setId(imagepath)
 	# Generates dialog for selecting image series to use
 	GD = GenericDialog("Select Image Series to Process")
 	NameList = [Metadata.getImageName(i) for i in range(MetaReader.getSeriesCount())]
@@ -525,69 +1392,141 @@ def main(imagepath,
 	# If the dialog is canceled, returns and terminates the macro
 	if GD.wasCanceled():
 		return
-	# Iterates through the selected series and sets on for import
-	for i in range(MetaReader.getSeriesCount()):
-		if GD.getNextBoolean():
-			Options.setSeriesOn(i, True)
-		else:
-			Options.setSeriesOn(i, False)
-	# Imports the image series'
-	Import = BF.openImagePlus(Options)
+	# Gets the indexes of the selected series
+	# These are imported one at a time later so the whole file is never held in memory
+	SeriesList = [i for i in range(MetaReader.getSeriesCount()) if GD.getNextBoolean()]
+	# Converts the prominence sweep into a list of floats
+	# Matches comma separated numbers
+	if prominence_sweep.strip():
+		if not re.match(r"^\s*\d+(\.\d+)?(\s*,\s*\d+(\.\d+)?)*\s*$", prominence_sweep):
+			IJ.error("Prominence sweep must be a comma separated list of numbers")
+			return
+		ProminenceList = [float(x) for x in prominence_sweep.split(",")]
+	else:
+		ProminenceList = None
 	# Reads the kernel file
 	kernel = open(kernel_file).read()
+	# Settings for every foci channel, all are counted against the same nuclei
+	try:
+		FociChannels = ([FociChannel("RAD51", RAD_channel, RAD_foci_rollingball, RAD_foci_prominence, kernel),
+						 FociChannel("yH2AX", yH2AX_channel, yH2AX_foci_rollingball, yH2AX_foci_prominence, kernel)]
+						+ parseFociChannels(extra_foci, kernel))
+	except ValueError as Error:
+		IJ.error(str(Error))
+		return
+	ChannelNames = [Settings.Name for Settings in FociChannels]
+	if len(set(ChannelNames)) != len(ChannelNames):
+		IJ.error("Foci channel names must be unique")
+		return
+	# Every ordered pair of channels is colocalised, not available for a prominence sweep
+	ColocPairs = []
+	if coloc_distance > 0 and not ProminenceList:
+		ColocPairs = [(Name, Other) for Name in ChannelNames for Other in ChannelNames if Other != Name]
 	# Initialises the output dictionary
 	OutputDict = {}
-	# Iterates through the series and runs the analysis
-	for series, Image in enumerate(Import):
-		# Shows the progress of the analysis
-		IJ.showProgress(series, len(Import))
+	# Settings shared by the analysis of every series
+	AnalysisSettings = {"Nuclei_rollingball": Nuclei_rollingball,
+						"size_setting": size_setting,
+						"circularity_setting": circularity_setting,
+						"testmode": testmode,
+						"labelmap": labelmap,
+						"prominence_sweep": ProminenceList,
+						"tile_size": tile_size,
+						"tile_workers": workers,
+						"save_foci": save_foci and long_format,
+						"channel_workers": 1,
+						"coloc_distance": coloc_distance}
+	LineList = ["Nuclei_rollingball=" + str(Nuclei_rollingball),
+					"Nuclei_Size_Setting=" + size_setting,
+					"Nuclei_Circularity_Setting=" + circularity_setting,
+					"Nuclei_Chan=" + str(nuclei_channel),
+					"RAD51_Chan=" + str(RAD_channel),
+					"yH2AX_Chan=" + str(yH2AX_channel),
+					"RAD51_RollingBallSize=" + str(RAD_foci_rollingball),
+					"RAD51_Prominence=" + str(RAD_foci_prominence),
+					"yH2AX_RollingBallSize=" + str(yH2AX_foci_rollingball),
+					"yH2AX_Prominence=" + str(yH2AX_foci_prominence),
+					"KernelFile=" + kernel_file,
+					"LabelMap=" + str(labelmap),
+					# Semicolon separated as the line is comma separated
+					"Prominence_Sweep=" + ";".join([str(x) for x in ProminenceList or []]),
+					"Extra_Foci=" + extra_foci,
+					"Colocalisation_Distance=" + str(coloc_distance)]
+	# Checks if the output path has a csv extension and adds it if not
+	if not re.search(r"\.csv$", outputpath, re.IGNORECASE):
+		outputpath += ".csv"
+	# Long format results are written as each series finishes so are not all kept in memory
+	Writer = None
+	if long_format and not testmode:
+		Writer = ResultsWriter(outputpath, LineList, ChannelNames, ProminenceList, save_foci, ColocPairs)
+
+	def record(Title, Analysis):
+		"""Records the results of an analysed series"""
+		if Writer:
+			Writer.writeSeries(Title, Analysis)
+		else:
+			recordResults(OutputDict, Title, Analysis)
+
+	# Settings that change the nuclei segmentation, used to identify saved segmentations
+	NucleiSettings = [Nuclei_rollingball, size_setting, circularity_setting, nuclei_channel]
+
+	def getSeriesSettings(series):
+		"""Gets the analysis settings for a single series"""
 		# Gets the physical size of the pixels
-		scale = Metadata.getPixelsPhysicalSizeX(series).value()
-		# Splits the image into channels
-		Channels = ChannelSplitter.split(Image)
-		# Initialises the analysis class
-		Analysis = HomologousRecombinationAnalysis(Channels[nuclei_channel-1],
-											 		Channels[RAD_channel-1],
-													Channels[yH2AX_channel-1],
-													Nuclei_rollingball,
-													size_setting,
-													circularity_setting,
-													RAD_foci_rollingball,
-													RAD_foci_prominence,
-													yH2AX_foci_rollingball,
-													yH2AX_foci_prominence,
-													kernel,
-													scale,
-													testmode
-													)
-		# Runs the analysis
-		Analysis.runMacro()
-		# Closes the channels and the original image
-		for Channel in Channels:
-			Channel.close()
-		Image.close()
-		# Adds the results to the output dictionary
-		try:
-			OutputDict[Image.getTitle() + " RAD51"] = Analysis.RAD51_PointList
-			OutputDict[Image.getTitle() + " yH2AX"] = Analysis.yH2AX_PointList
-		# Except will catch if the analysis has not been run
-		except AttributeError:
-			continue	
-	if not testmode:
-		LineList = ["Nuclei_rollingball=" + str(Nuclei_rollingball),
-						"Nuclei_Size_Setting=" + size_setting,
-						"Nuclei_Circularity_Setting=" + circularity_setting,
-						"Nuclei_Chan=" + str(nuclei_channel),
-						"RAD51_Chan=" + str(RAD_channel),
-						"yH2AX_Chan=" + str(yH2AX_channel),
-						"RAD51_RollingBallSize=" + str(RAD_foci_rollingball),
-						"RAD51_Prominence=" + str(RAD_foci_prominence),
-						"yH2AX_RollingBallSize=" + str(yH2AX_foci_rollingball),
-						"yH2AX_Prominence=" + str(yH2AX_foci_prominence),
-						"KernelFile=" + kernel_file]
-		# Checks if the output path has a csv extension and adds it if not
-		if not re.search(r"\.csv$", outputpath, re.IGNORECASE):
-			outputpath += ".csv"
+		SeriesSettings = dict(AnalysisSettings, scale=Metadata.getPixelsPhysicalSizeX(series).value())
+		# Test mode always segments the nuclei as the settings are being changed
+		if reuse_nuclei and not testmode:
+			SeriesSettings["nuclei_roiset"] = nucleiRoiSetPath(imagepath, outputpath, series, NucleiSettings)
+		# Series run one at a time without tiles use the workers for the foci channels
+		if not testmode and workers > 1 and tile_size <= 0 and SeriesAtOnce == 1:
+			SeriesSettings["channel_workers"] = workers
+		return SeriesSettings
+
+	# Test mode is interactive so has to be run one series at a time
+	# Tiled analysis uses the workers for the tiles so the series are run one at a time
+	# A single series uses the workers for its foci channels
+	SeriesAtOnce = 1 if testmode or workers <= 1 or tile_size > 0 or len(SeriesList) == 1 else workers
+	try:
+		if SeriesAtOnce == 1:
+			# Iterates through the series and runs the analysis
+			for Index, (series, Image) in enumerate(iterateSeries(imagepath, SeriesList)):
+				# Shows the progress of the analysis
+				IJ.showProgress(Index, len(SeriesList))
+				SeriesSettings = getSeriesSettings(series)
+				# Runs the analysis
+				Analysis = analyzeSeries(Image, nuclei_channel, FociChannels, SeriesSettings)
+				# Records the results
+				record(Image.getTitle(), Analysis)
+		else:
+			Pool = Executors.newFixedThreadPool(workers)
+			# Futures of the series currently being imported or analysed
+			# Limited to the number of workers so only that many series are in memory at once
+			Pending = deque()
+			Finished = 0
+			try:
+				for series in SeriesList:
+					# Waits for the oldest series if the window is full
+					# Results are collected in series order so the output is deterministic
+					if len(Pending) >= workers:
+						Title, Analysis = Pending.popleft().get()
+						record(Title, Analysis)
+						Finished += 1
+						IJ.showProgress(Finished, len(SeriesList))
+					SeriesSettings = getSeriesSettings(series)
+					Pending.append(Pool.submit(SeriesTask(imagepath, series, nuclei_channel, FociChannels, SeriesSettings)))
+				# Collects the remaining series
+				while Pending:
+					Title, Analysis = Pending.popleft().get()
+					record(Title, Analysis)
+					Finished += 1
+					IJ.showProgress(Finished, len(SeriesList))
+			finally:
+				Pool.shutdown()
+	finally:
+		# Closes the long format files even if a series fails so the finished series are kept
+		if Writer:
+			Writer.close()
+	if not Writer and not testmode:
 		# Opens the csv file in write mode
 		csvfile = open(outputpath, "w")
 		# Writes the settings to the first line of the csv file
@@ -612,5 +1551,14 @@ if __name__ == "__main__":
 		 yH2AX_Foci_RollingBall,
 		 yH2AX_Foci_Prominence,
 		 KernelFile.getPath(),
-		 TestMode
+		 TestMode,
+		 LabelMapMode,
+		 Workers,
+		 Prominence_Sweep,
+		 ReuseNuclei,
+		 TileSize,
+		 LongFormat,
+		 SaveFoci,
+		 Extra_Foci,
+		 Coloc_Distance
 		)
\ No newline at end of file